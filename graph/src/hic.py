@@ -1,3 +1,11 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import datetime as dt
+import logging
+import multiprocessing as mp
+import numpy as np
+import pysam
 import vcf
 
 #
@@ -13,10 +21,13 @@ def count_vcf_records(fname):
 # Represents the placement of a read within an
 # assembly or mapping.
 #
-class ReadPlacement:
+class ReadPlacement(object):
+    __slots__ = ('contig', 'position', 'mapq', 'snpSet', 'snpInstances')
+
     def __init__(self, contig, position):
         self.contig = contig
         self.position = position
+        self.mapq = None
         self.snpSet = set()
         self.snpInstances = {}
 
@@ -55,7 +66,12 @@ class ReadPlacement:
 # Represents a fragment generated from HiC proximity ligation.
 # Effectively, this is the same as any other DNA insert.
 #
-class Fragment:
+class Fragment(object):
+    __slots__ = ('name', 'read1', 'read2')
+
+    @staticmethod
+    def identity(name):
+        return name
 
     def __init__(self, name):
         self.name = name
@@ -88,7 +104,12 @@ class Fragment:
 #
 # A SNP site, defined by contig and position
 #
-class SNP:
+class SNP(object):
+    __slots__ = ('vcfRecord', 'reference', 'variant', 'alleles')
+
+    @staticmethod
+    def identity(vcfRecord):
+        return vcfRecord.CHROM, vcfRecord.POS
 
     def __init__(self, vcfRecord):
         self.vcfRecord = vcfRecord
@@ -177,6 +198,10 @@ class SNP:
 #
 # With a type and attr, could call type(classname, object, attr*)
 #
+# Classes which define a static identity method are looked up by the
+# identity of the requested attributes, so that an instance is only
+# created when it is new.
+#
 class RegisteredObjectFactory:
 
     def __init__(self, clazz):
@@ -186,23 +211,635 @@ class RegisteredObjectFactory:
     def __len__(self):
         return len(self.registry)
 
+    #
+    # Key of an object in the registry. Without an identity method, the
+    # object itself is created and acts as its own key.
+    #
+    def _key(self, kwargs):
+        if hasattr(self.clazz, 'identity'):
+            return self.clazz.identity(**kwargs)
+        return self.clazz(**kwargs)
+
     #
     # Create a new object instance and register it.
     #
     def requestObject(self, **kwargs):
-        obj = self.clazz(**kwargs)
-        if obj in self.registry:
-            obj = self.registry[obj]
-        else:
-            self.registry[obj] = obj
+        key = self._key(kwargs)
+        obj = self.registry.get(key)
+        if obj is None:
+            obj = key if isinstance(key, self.clazz) else self.clazz(**kwargs)
+            self.registry[key] = obj
         return obj
 
     #
     # Get the object or raise exception
     #
     def getObject(self, **kwargs):
-        obj = self.clazz(**kwargs)
-        return self.registry[obj]
+        return self.registry[self._key(kwargs)]
 
     def elements(self):
         return self.registry.values()
+
+
+#
+# Counts of the reasons for which variants, observations and fragments were
+# rejected. Logging every case can dominate the runtime on deep data, so
+# individual cases are only logged for a random sample, at the given rate.
+#
+class Diagnostics:
+
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.counts = OrderedDict()
+
+    def __getitem__(self, reason):
+        return self.counts.get(reason, 0)
+
+    #
+    # Count a single case. If sampled, describe() provides its log message.
+    #
+    def count(self, reason, describe=None, level=logging.INFO):
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+        if describe is not None and self.sample_rate > 0 and np.random.random() < self.sample_rate:
+            logging.log(level, '%s: %s', reason, describe())
+
+    #
+    # Count the cases flagged by a mask. If sampled, describe(k) provides
+    # the log message of case k.
+    #
+    def record(self, reason, mask, describe=None, level=logging.INFO):
+        cases = np.flatnonzero(mask)
+        self.counts[reason] = self.counts.get(reason, 0) + len(cases)
+        if describe is not None and self.sample_rate > 0:
+            for k in cases[np.random.random(len(cases)) < self.sample_rate]:
+                logging.log(level, '%s: %s', reason, describe(k))
+
+    def merge(self, counts):
+        for reason, n in counts.iteritems():
+            self.counts[reason] = self.counts.get(reason, 0) + n
+
+    #
+    # Print and log the counts
+    #
+    def report(self, title):
+        print title
+        logging.info(title)
+        for reason, n in self.counts.iteritems():
+            print '  {0}: {1}'.format(reason, n)
+            logging.info('  %s: %d', reason, n)
+
+
+#
+# Numpy view of an array.array column
+#
+def _column(arr, dtype):
+    if len(arr) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(arr, dtype=dtype)
+
+
+#
+# Columnar registry of SNPs, fragments and the allele observations which
+# link them.
+#
+# Fragment (read) names and contigs are interned to integer ids. The placement
+# of each read end is held in arrays indexed by fragment id and every base
+# observed at a SNP is a row of (snp_id, frag_id, read end, allele) columns,
+# where the allele is 0 for the reference and 1 for the variant.
+#
+# Only SNPs are held as objects. Fragments, read placements and allele lists
+# are created on request as views of the columns.
+#
+class AlleleRegistry:
+
+    def __init__(self):
+        self.snps = []
+        self.snp_index = {}
+        self.frag_names = []
+        self.frag_index = {}
+        self.contig_names = []
+        self.contig_index = {}
+        # contig id and position of R1 and R2 placements, -1 when unplaced
+        self.place_contig = (array('i'), array('i'))
+        self.place_pos = (array('i'), array('i'))
+        # allele observations
+        self.obs_snp = array('i')
+        self.obs_frag = array('i')
+        self.obs_read = array('b')
+        self.obs_allele = array('b')
+        # ASCII codes of reference and variant bases by snp id, built on request
+        self._codes = None
+
+    def __len__(self):
+        return len(self.frag_names)
+
+    #
+    # Register a SNP from a VCF record, returning its id. Records of
+    # existing sites return the existing id.
+    #
+    def add_snp(self, vcfRecord):
+        key = SNP.identity(vcfRecord)
+        snp_id = self.snp_index.get(key)
+        if snp_id is None:
+            snp = SNP(vcfRecord)
+            snp_id = len(self.snps)
+            self.snp_index[key] = snp_id
+            self.snps.append(snp)
+        return snp_id
+
+    #
+    # Intern a fragment name, returning its id.
+    #
+    def add_fragment(self, name):
+        frag_id = self.frag_index.get(name)
+        if frag_id is None:
+            frag_id = len(self.frag_names)
+            self.frag_index[name] = frag_id
+            self.frag_names.append(name)
+            for i in xrange(2):
+                self.place_contig[i].append(-1)
+                self.place_pos[i].append(-1)
+        return frag_id
+
+    def _contig_id(self, contig):
+        ctg_id = self.contig_index.get(contig)
+        if ctg_id is None:
+            ctg_id = len(self.contig_names)
+            self.contig_index[contig] = ctg_id
+            self.contig_names.append(contig)
+        return ctg_id
+
+    #
+    # Place read end (0=R1, 1=R2) of a fragment. The first placement is kept,
+    # returning False if it disagrees with this one.
+    #
+    def place(self, frag_id, read, contig, position):
+        ctg_id = self._contig_id(contig)
+        if self.place_contig[read][frag_id] == -1:
+            self.place_contig[read][frag_id] = ctg_id
+            self.place_pos[read][frag_id] = position
+            return True
+        return self.place_contig[read][frag_id] == ctg_id and self.place_pos[read][frag_id] == position
+
+    #
+    # Record the observation of a base at a SNP by read end (0=R1, 1=R2) of
+    # a fragment. The base must be either the reference or variant allele.
+    #
+    def observe(self, snp_id, frag_id, read, base):
+        snp = self.snps[snp_id]
+        base = base.upper()
+        if base == snp.reference:
+            allele = 0
+        elif base == snp.variant:
+            allele = 1
+        else:
+            raise ValueError('{0} is neither reference {1} nor variant {2} of SNP:{3}'.format(
+                base, snp.reference, snp.variant, snp))
+        self.obs_snp.append(snp_id)
+        self.obs_frag.append(frag_id)
+        self.obs_read.append(read)
+        self.obs_allele.append(allele)
+
+    #
+    # ASCII codes of the reference and variant base of each SNP, as
+    # arrays indexed by snp id.
+    #
+    def allele_codes(self):
+        if self._codes is None or len(self._codes[0]) != len(self.snps):
+            self._codes = (np.array([ord(snp.reference) for snp in self.snps], dtype=np.uint8),
+                           np.array([ord(snp.variant) for snp in self.snps], dtype=np.uint8))
+        return self._codes
+
+    #
+    # Register the selected rows of a site table (see site_table) as
+    # observations by read end (0=R1, 1=R2), where variant flags the rows
+    # which observed the variant rather than the reference allele. Each
+    # alignment with a selected row is placed once, in alignment order.
+    #
+    # Returns the placements which disagree with existing ones as a list
+    # of (fragment name, read end, contig, position)
+    #
+    def add_hits(self, table, selected, variant, read, contig):
+        rows = np.flatnonzero(selected)
+        alns = np.unique(table['aln'][rows])
+        frag_ids = np.empty(len(alns), dtype=np.int32)
+        conflicts = []
+        for n, k in enumerate(alns):
+            name = table['names'][k]
+            frag_ids[n] = self.add_fragment(name)
+            if not self.place(frag_ids[n], read, contig, table['pos'][k]):
+                conflicts.append((name, read, contig, table['pos'][k]))
+
+        self.obs_snp.fromstring(table['snp'][rows].astype(np.int32).tostring())
+        self.obs_frag.fromstring(frag_ids[np.searchsorted(alns, table['aln'][rows])].tostring())
+        self.obs_read.fromstring(np.repeat(np.int8(read), len(rows)).tostring())
+        self.obs_allele.fromstring(variant[rows].astype(np.int8).tostring())
+        return conflicts
+
+    #
+    # An empty registry sharing the SNPs of this one, for collecting the
+    # observations at a subset of the sites.
+    #
+    def partial(self):
+        reg = AlleleRegistry()
+        reg.snps = self.snps
+        reg.snp_index = self.snp_index
+        reg._codes = self.allele_codes()
+        return reg
+
+    #
+    # Fragments, placements and observations as a table which can be
+    # merged into another registry sharing the same SNPs.
+    #
+    def export(self):
+        return {'frag_names': self.frag_names, 'contig_names': self.contig_names,
+                'place_contig': self.place_contig, 'place_pos': self.place_pos,
+                'obs_snp': self.obs_snp, 'obs_frag': self.obs_frag,
+                'obs_read': self.obs_read, 'obs_allele': self.obs_allele}
+
+    #
+    # Merge a table exported by a partial registry, joining fragments by
+    # name. Placements are merged as though the reads of the partial had
+    # been placed after those of this registry.
+    #
+    # Returns the placements which disagree with existing ones as a list
+    # of (fragment name, read end, contig, position)
+    #
+    def merge(self, table):
+        frag_ids = np.array([self.add_fragment(name) for name in table['frag_names']], dtype=np.int32)
+        conflicts = []
+        for read in xrange(2):
+            place_contig = table['place_contig'][read]
+            place_pos = table['place_pos'][read]
+            for local_id in np.flatnonzero(_column(place_contig, np.int32) != -1):
+                contig = table['contig_names'][place_contig[local_id]]
+                if not self.place(frag_ids[local_id], read, contig, place_pos[local_id]):
+                    conflicts.append((table['frag_names'][local_id], read, contig, place_pos[local_id]))
+        self.obs_snp.extend(table['obs_snp'])
+        self.obs_frag.fromstring(frag_ids[_column(table['obs_frag'], np.int32)].tostring())
+        self.obs_read.extend(table['obs_read'])
+        self.obs_allele.extend(table['obs_allele'])
+        return conflicts
+
+    #
+    # Allele observations as numpy columns. If unique, only the first
+    # observation of each SNP by each read end is retained.
+    #
+    def observations(self, unique=False):
+        obs = {'snp': _column(self.obs_snp, np.int32),
+               'frag': _column(self.obs_frag, np.int32),
+               'read': _column(self.obs_read, np.int8),
+               'allele': _column(self.obs_allele, np.int8)}
+        if unique and len(obs['snp']) > 0:
+            key = (obs['frag'].astype(np.int64) * 2 + obs['read']) * len(self.snps) + obs['snp']
+            first = np.sort(np.unique(key, return_index=True)[1])
+            obs = dict((k, v[first]) for k, v in obs.iteritems())
+        return obs
+
+    #
+    # Count of observations of each allele of each SNP, as an array
+    # of shape (n_snps, 2) with columns reference and variant.
+    #
+    def allele_counts(self):
+        obs = self.observations()
+        counts = np.bincount(obs['snp'].astype(np.int64) * 2 + obs['allele'], minlength=2 * len(self.snps))
+        return counts.reshape(len(self.snps), 2)
+
+    #
+    # Pair every R1 observation with every R2 observation of the same
+    # fragment. Only fragments with observations at both ends are paired.
+    #
+    # Returns the unique observations and the index arrays (i, j) of the
+    # R1 and R2 observation of each pairing.
+    #
+    def linked_observations(self):
+        obs = self.observations(unique=True)
+        order = np.lexsort((obs['read'], obs['frag']))
+        r1 = order[obs['read'][order] == 0]
+        r2 = order[obs['read'][order] == 1]
+
+        # R2 observations of the same fragment as each R1 observation
+        f2 = obs['frag'][r2]
+        lo = np.searchsorted(f2, obs['frag'][r1], side='left')
+        n = np.searchsorted(f2, obs['frag'][r1], side='right') - lo
+        offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        return obs, np.repeat(r1, n), r2[np.repeat(lo, n) + offset]
+
+    def is_paired(self):
+        return (_column(self.place_contig[0], np.int32) != -1) & (_column(self.place_contig[1], np.int32) != -1)
+
+    #
+    # Facade objects
+    #
+
+    def snp(self, snp_id):
+        return self.snps[snp_id]
+
+    def placement(self, frag_id, read):
+        ctg_id = self.place_contig[read][frag_id]
+        if ctg_id == -1:
+            return None
+        return ReadPlacement(self.contig_names[ctg_id], self.place_pos[read][frag_id])
+
+    def _fragment(self, frag_id, obs, rows):
+        frg = Fragment(self.frag_names[frag_id])
+        frg.read1 = self.placement(frag_id, 0)
+        frg.read2 = self.placement(frag_id, 1)
+        for k in rows:
+            snp = self.snps[obs['snp'][k]]
+            rpl = frg.read1 if obs['read'][k] == 0 else frg.read2
+            rpl.snpSet.add(snp)
+            rpl.snpInstances[snp] = snp.variant if obs['allele'][k] else snp.reference
+        return frg
+
+    #
+    # Build a Fragment view, whose placements carry the SNPs and
+    # bases observed by each read end.
+    #
+    def fragment(self, frag_id):
+        obs = self.observations(unique=True)
+        return self._fragment(frag_id, obs, np.flatnonzero(obs['frag'] == frag_id))
+
+    def fragments(self):
+        obs = self.observations(unique=True)
+        order = np.argsort(obs['frag'], kind='mergesort')
+        bounds = np.searchsorted(obs['frag'][order], np.arange(len(self.frag_names) + 1))
+        for frag_id in xrange(len(self.frag_names)):
+            yield self._fragment(frag_id, obs, order[bounds[frag_id]:bounds[frag_id+1]])
+
+    #
+    # Names of the fragments observed with each allele of a SNP.
+    #
+    def alleles(self, snp_id):
+        snp = self.snps[snp_id]
+        obs = self.observations()
+        alleles = {}
+        for k in np.flatnonzero(obs['snp'] == snp_id):
+            base = snp.variant if obs['allele'][k] else snp.reference
+            alleles.setdefault(base, []).append(self.frag_names[obs['frag'][k]])
+        return alleles
+
+
+#
+# Group the SNPs of a registry by contig, with each group
+# sorted by position. Contigs are in order of first appearance.
+#
+# Returns an ordered dict of contig -> (positions, snp ids), where
+# positions are 0-based.
+#
+def variant_sites(registry):
+    sites = OrderedDict()
+    for snp_id, snp in enumerate(registry.snps):
+        sites.setdefault(snp.contig, []).append((snp.position - 1, snp_id))
+    for contig, ctg_sites in sites.iteritems():
+        ctg_sites.sort()
+        sites[contig] = ([pos for pos, snp_id in ctg_sites], [snp_id for pos, snp_id in ctg_sites])
+    return sites
+
+
+# CIGAR operations which consume the reference and query together,
+# only the query or only the reference.
+_ALIGNED_OPS = {0, 7, 8}
+_QUERY_OPS = {1, 4}
+_REF_OPS = {2, 3}
+
+# operations counted as an indel when they follow a base, as in a pileup
+_INDEL_OPS = {1, 2}
+
+
+#
+# Walk the CIGAR of an alignment and find the sites it covers with an
+# aligned base. Sites which fall within deletions or skipped regions have
+# no base and are not reported.
+#
+# As in a pileup, a base directly followed by an insertion or deletion is
+# flagged as an indel.
+#
+# Returns a list of (site index, query position, indel)
+#
+def read_sites(cigartuples, reference_start, positions):
+    hits = []
+    rpos = reference_start
+    qpos = 0
+    n_ops = len(cigartuples)
+    for k in xrange(n_ops):
+        op, n = cigartuples[k]
+        if op in _ALIGNED_OPS:
+            for s in xrange(bisect_left(positions, rpos), bisect_left(positions, rpos + n)):
+                offset = positions[s] - rpos
+                indel = offset == n - 1 and k + 1 < n_ops and cigartuples[k + 1][0] in _INDEL_OPS
+                hits.append((s, qpos + offset, indel))
+            rpos += n
+            qpos += n
+        elif op in _QUERY_OPS:
+            qpos += n
+        elif op in _REF_OPS:
+            rpos += n
+    return hits
+
+
+# bases of lower quality were never reported by the pileup which the sweep
+# below replaced, this being the default min_base_quality of pysam's pileup
+PILEUP_MIN_BASE_QUALITY = 13
+
+
+#
+# Walk the alignments of a contig once and yield each which covers any
+# of the given variant sites, along with the sites it covers. Unmapped,
+# QC failed and duplicate alignments are skipped, as they are in a pileup.
+#
+# Yields (alignment, list of (snp id, query position, indel))
+#
+def scan_sites(bam, contig, positions, snp_ids):
+    for aln in bam.fetch(contig, positions[0], positions[-1] + 1):
+        if aln.is_unmapped or aln.is_qcfail or aln.is_duplicate:
+            continue
+        hits = read_sites(aln.cigartuples, aln.reference_start, positions)
+        if hits:
+            yield aln, [(snp_ids[s], qpos, indel) for s, qpos, indel in hits]
+
+
+# number of alignments whose sequences and qualities are held at once
+_SITE_CHUNK = 10000
+
+
+#
+# Append the bases and qualities at the given offsets of the concatenated
+# sequences and qualities of a chunk of alignments.
+#
+def _take_bases(seqs, quals, offsets, hit_base, hit_bq):
+    offsets = _column(offsets, np.int32)
+    hit_base.fromstring(np.frombuffer(''.join(seqs), dtype=np.uint8)[offsets].tostring())
+    hit_bq.fromstring(np.frombuffer(''.join(quals), dtype=np.uint8)[offsets].tostring())
+
+
+#
+# Gather the alignments of a contig which cover variant sites into a site table,
+# with a row per site covered by an alignment. The bases and qualities of the
+# rows are taken at once from the concatenated sequences and qualities of chunks
+# of alignments, so that only a chunk of whole reads is held at any time.
+#
+# Returns None if no alignment covers a site, otherwise a dict of columns:
+#   per alignment: names, pos, mapq, secondary
+#   per row: aln (alignment index), snp, indel, base (ASCII code), bq
+#
+def site_table(bam, contig, positions, snp_ids):
+    names = []
+    pos = array('i')
+    mapq = array('i')
+    secondary = array('b')
+    hit_aln = array('i')
+    hit_snp = array('i')
+    hit_indel = array('b')
+    hit_base = array('B')
+    hit_bq = array('B')
+    seqs = []
+    quals = []
+    chunk_offset = array('i')
+    offset = 0
+    for aln, hits in scan_sites(bam, contig, positions, snp_ids):
+        k = len(names)
+        names.append(aln.query_name)
+        pos.append(aln.reference_start)
+        mapq.append(aln.mapping_quality)
+        secondary.append(aln.is_secondary)
+
+        for snp_id, qpos, indel in hits:
+            hit_aln.append(k)
+            hit_snp.append(snp_id)
+            hit_indel.append(indel)
+            chunk_offset.append(offset + qpos)
+
+        # secondary alignments may omit their sequence and qualities
+        seq = aln.query_sequence
+        if seq is None:
+            seq = 'N' * (hits[-1][1] + 1)
+        qual = aln.query_qualities
+        quals.append('\0' * len(seq) if qual is None else qual.tostring())
+        seqs.append(seq)
+        offset += len(seq)
+
+        if len(seqs) == _SITE_CHUNK:
+            _take_bases(seqs, quals, chunk_offset, hit_base, hit_bq)
+            seqs = []
+            quals = []
+            chunk_offset = array('i')
+            offset = 0
+
+    if len(names) == 0:
+        return None
+    if seqs:
+        _take_bases(seqs, quals, chunk_offset, hit_base, hit_bq)
+
+    return {'names': names,
+            'pos': _column(pos, np.int32),
+            'mapq': _column(mapq, np.int32),
+            'secondary': _column(secondary, np.int8).astype(bool),
+            'aln': _column(hit_aln, np.int32),
+            'snp': _column(hit_snp, np.int32),
+            'indel': _column(hit_indel, np.int8).astype(bool),
+            'base': _column(hit_base, np.uint8),
+            'bq': _column(hit_bq, np.uint8)}
+
+
+# state shared with worker processes, which inherit it when forked
+_COLLECT = None
+
+
+def _open_bams():
+    # forked workers would otherwise sample the same cases for logging
+    np.random.seed()
+    _COLLECT['sams'] = [pysam.Samfile(fn, 'rb') for fn in _COLLECT['bam_files']]
+
+
+#
+# Worker collecting the alleles of a single contig into a partial registry.
+#
+def _collect_contig(contig):
+    positions, snp_ids = _COLLECT['sites'][contig]
+    partial = _COLLECT['registry'].partial()
+    diagnostics = Diagnostics(_COLLECT['sample_rate'])
+    _COLLECT['collect'](partial, diagnostics, contig, positions, snp_ids, _COLLECT['sams'])
+    return partial.export(), diagnostics.counts
+
+
+#
+# Collect the alleles observed at all variant sites of a registry, contig
+# by contig. For each contig, collect(registry, diagnostics, contig, positions, snp_ids, sams)
+# is called with the open R1 and R2 bam files, to scan the contig's sites
+# and record what it observes in the registry and what it rejects in the
+# diagnostics.
+#
+# With more than one process, contigs are collected independently by a pool of
+# workers, each holding only the observations of its current contig. The partial
+# registries are merged in contig order, so the result is that of a serial run.
+# Only the diagnostics may differ, as placement conflicts between contigs are then
+# counted once per read placement, rather than once per alignment.
+#
+# Returns the diagnostics, counting the rejections of all contigs.
+#
+def collect_alleles(registry, collect, bam_files, processes=1, diagnostics=None):
+    global _COLLECT
+
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+
+    sites = variant_sites(registry)
+
+    if processes > 1:
+        _COLLECT = {'registry': registry, 'sites': sites, 'collect': collect, 'bam_files': bam_files,
+                    'sample_rate': diagnostics.sample_rate}
+        pool = mp.Pool(processes, _open_bams)
+        tables = pool.imap(_collect_contig, sites.keys())
+    else:
+        sams = [pysam.Samfile(fn, 'rb') for fn in bam_files]
+
+    try:
+        firstTime = dt.datetime.now()
+        lastTime = firstTime
+        for ctgCount, (contig, (positions, snp_ids)) in enumerate(sites.iteritems(), start=1):
+
+            if processes > 1:
+                table, counts = next(tables)
+                diagnostics.merge(counts)
+                for conflict in registry.merge(table):
+                    diagnostics.count('conflicting placement', lambda: describe_conflict(conflict), logging.WARNING)
+            else:
+                collect(registry, diagnostics, contig, positions, snp_ids, sams)
+
+            if ctgCount % 100 == 0:
+                curTime = dt.datetime.now()
+                ta = (curTime - lastTime)
+                tb = (curTime - firstTime)
+                print "...processed {0}/{1} contigs in {2} walltime: {3}".format(ctgCount, len(sites), ta, tb)
+                lastTime = curTime
+
+    except:
+        # a failed contig surfaces here, so do not wait on the remaining contigs
+        if processes > 1:
+            pool.terminate()
+        raise
+
+    else:
+        if processes > 1:
+            pool.close()
+
+    finally:
+        if processes > 1:
+            pool.join()
+            _COLLECT = None
+        else:
+            for sam in sams:
+                sam.close()
+
+    return diagnostics
+
+
+#
+# Log message for a placement conflict, as returned by AlleleRegistry.add_hits
+# and merge.
+#
+def describe_conflict(conflict):
+    name, read, contig, pos = conflict
+    return 'tried to assign different read placement r{0} [{1}] to fragment [{2}]'.format(
+        read + 1, ReadPlacement(contig, pos), name)
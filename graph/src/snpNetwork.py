@@ -1,10 +1,9 @@
 from hic import *
 import networkx as nx
-import datetime as dt
+import numpy as np
 import os.path
 import argparse
 import logging
-import pysam
 import vcf
 import sys
 
@@ -12,13 +11,6 @@ import sys
 logging.basicConfig(filename='snpNetwork.log',level=logging.DEBUG)
 
 
-#
-# Read base and quality
-#
-def read_base_and_quality(alignedRead, pos):
-    return alignedRead.seq[pos], ord(alignedRead.qual[pos]) - 33
-
-
 #
 # Test for file existence or raise an error
 #
@@ -27,12 +19,59 @@ def file_exists(fnames):
         if not os.path.exists(fn):
             raise IOError('Error: \"{0}\" does not exist'.format(fn))
 
+#
+# Collect the alleles observed by R1 and R2 reads at the variant sites of a contig.
+# The bases and qualities of all reads are extracted together, with the
+# filters applied as masks.
+#
+def collect(registry, diagnostics, scfName, positions, snp_ids, sams):
+    ref, var = registry.allele_codes()
+
+    # R1 reads are read end 0 and R2 reads are read end 1
+    for read, sam in enumerate(sams):
+
+        table = site_table(sam, scfName, positions, snp_ids)
+        if table is None:
+            continue
+        aln = table['aln']
+        names = table['names']
+
+        # skip secondary alignments and indels
+        secondary = table['secondary'][aln]
+        diagnostics.record('secondary', secondary, lambda k: names[aln[k]], logging.DEBUG)
+        indel = ~secondary & table['indel']
+        diagnostics.record('indel', indel, lambda k: names[aln[k]], logging.DEBUG)
+        rejected = secondary | indel
+
+        # minimum base quality
+        low_quality = ~rejected & (table['bq'] < 30)
+        diagnostics.record('low base quality', low_quality,
+                           lambda k: 'bq={0} {1}'.format(table['bq'][k], names[aln[k]]))
+        rejected |= low_quality
+
+        # skip undefined variants
+        is_ref = table['base'] == ref[table['snp']]
+        is_var = table['base'] == var[table['snp']]
+        undefined = ~rejected & ~(is_ref | is_var)
+        diagnostics.record('undefined allele', undefined, lambda k: '{0} was not ref {1} nor alt {2}'.format(
+            chr(table['base'][k]), registry.snp(table['snp'][k]).reference, registry.snp(table['snp'][k]).variant))
+        rejected |= undefined
+
+        # register alleles, placing their fragments
+        for conflict in registry.add_hits(table, ~rejected, is_var, read, scfName):
+            diagnostics.count('conflicting placement', lambda: describe_conflict(conflict), logging.WARNING)
+
+
 #
 # User interface
 #
 parser = argparse.ArgumentParser(description='Build snp graph from HiC sequencing data')
 parser.add_argument('--split', dest='split_node', help='Binary variant states are treated as independent nodes',
                     action='store_true', default=False)
+parser.add_argument('-p', '--processes', help='Number of processes collecting contigs in parallel', type=int,
+                    default=1)
+parser.add_argument('--log-sample', type=float, default=0.0,
+                    help='Fraction of rejected variants and observations to log individually [0]')
 parser.add_argument('vcf_file', help='VCF file of predicted variant sites', metavar='VCF_FILE')
 parser.add_argument('r1_file', help='BAM file for R1 reads', metavar='R1_BAM')
 parser.add_argument('r2_file', help='BAM file for R2 reads', metavar='R2_BAM')
@@ -45,139 +84,38 @@ try:
     file_exists([args.vcf_file, args.r1_file, args.r2_file])
 
     vcfFile = vcf.Reader(filename=args.vcf_file)
-    samR1 = pysam.Samfile(args.r1_file, 'rb')
-    samR2 = pysam.Samfile(args.r2_file, 'rb')
 
-    varCount = 0
-    firstTime = dt.datetime.now()
-    lastTime = firstTime
+    # Registry for tracking fragments, snps and the alleles observed by each read
+    registry = AlleleRegistry()
 
-    # Registry objects for tracking fragments and snps
-    frgRegistry = RegisteredObjectFactory(Fragment)
-    snpRegistry = RegisteredObjectFactory(SNP)
+    # Counts of rejected variants and observations
+    diagnostics = Diagnostics(args.log_sample)
 
     for variant in vcfFile:
 
         # Skip any variant that isn't a SNP
         if not variant.is_snp:
+            diagnostics.count('not a snp')
             continue
 
-        snpPos = variant.POS
-        scfName = variant.CHROM
-
         try:
-            snp = snpRegistry.requestObject(vcfRecord=variant)
+            registry.add_snp(variant)
         except Exception as ex:
-            logging.info('Skipping: %s', ex)
+            diagnostics.count('unsupported variant', lambda: str(ex))
             continue
 
-        # Iterate over R1 mapping, looking at the pileup at SNP position
-        for n, col in enumerate(samR1.pileup(reference=scfName, start=snpPos-1, end=snpPos, truncate=True)):
-
-            if n > 1:
-                raise Exception('Pileup is assumed to produced only one exact column')
-
-            for pr in col.pileups:
-
-                aln = pr.alignment
-
-                # skip secondary alignments and indels
-                if aln.is_secondary or pr.indel != 0:
-                    logging.debug('Skipped secondary or indel: %s', aln)
-                    continue
-
-                # nucleotide at SNP site for this read.
-                base, bq = read_base_and_quality(aln, pr.qpos)
-                mq = aln.mapq
-
-                if bq < 30:
-                    continue
-
-#                if aln.qname == 'M00958:3:000000000-A44NP:1:2110:22807:10490':
-#                    print 'r1',snpPos, base, bq, mq
-#                    print aln
-
-                # skip undefined variants
-                if snp.isUndefinedAllele(base):
-                    logging.info('%s was not ref %s nor alt %s', base, snp.reference, snp.variant)
-                    continue
-
-                # Obtain fragment from registry
-                frg = frgRegistry.requestObject(name=aln.qname)
-
-                rpl = ReadPlacement(scfName, aln.pos)
-                if not frg.read1:
-                    frg.read1 = rpl
-                elif rpl != frg.read1:
-                    logging.warn('Tried to assign different read placement r1 [%s] to fragment [%s]', rpl, frg)
-
-                # register allele
-                snp.addAllele(base, aln.qname)
-                try:
-                    frg.read1.addSnp(snp)
-                except Exception as ex:
-                    logging.warn('%s', ex)
+    varCount = len(registry.snps)
 
-        # Now iterate over R2 mapping, looking at the pileup at SNP position
-        for n, col in enumerate(samR2.pileup(reference=scfName, start=snpPos-1, end=snpPos, truncate=True)):
-
-            if n > 1:
-                raise Exception('Pileup is assumed to produced only one exact column')
-
-            for pr in col.pileups:
-
-                aln = pr.alignment
-
-                # skip secondary alignments and indels
-                if aln.is_secondary or pr.indel != 0:
-                    logging.debug('Skipped secondary or indel: %s', aln)
-                    continue
-
-                base, bq = read_base_and_quality(aln, pr.qpos)
-                mq = aln.mapq
-
-                if bq < 30:
-                    continue
-
-#                if aln.qname == 'M00958:3:000000000-A44NP:1:2110:22807:10490':
-#                    print 'r2',snpPos, base, bq, mq
-#                    print aln
-
-                # skip undefined variants
-                if snp.isUndefinedAllele(base):
-                    logging.info('%s was not ref %s nor alt %s', base, snp.reference, snp.variant)
-                    continue
-
-                # Obtain fragment from registry
-                frg = frgRegistry.requestObject(name=aln.qname)
-
-                rpl = ReadPlacement(scfName, aln.pos)
-                if not frg.read2:
-                    frg.read2 = rpl
-                elif rpl != frg.read2:
-                    logging.warn('Tried to assign different read placement r2 [%s] to fragment [%s]', rpl, frg)
-
-                # register allele
-                snp.addAllele(base, aln.qname)
-                try:
-                    frg.read2.addSnp(snp)
-                except Exception as ex:
-                    logging.warn('%s', ex)
-
-        varCount += 1
-        if varCount % 100 == 0:
-            curTime = dt.datetime.now()
-            ta = (curTime - lastTime)
-            tb = (curTime - firstTime)
-            print "...processed {0} variants in {1} walltime: {2}".format(varCount, ta, tb)
-            lastTime = curTime
+    #
+    # Variant sites are visited contig by contig, where each BAM file is walked
+    # once per contig and every read reports the bases it holds at all the sites
+    # it covers. Contigs may be collected by parallel processes.
+    #
+    collect_alleles(registry, collect, [args.r1_file, args.r2_file], args.processes, diagnostics)
 
     print 'Finished reading data, {0} variants'.format(varCount)
 
-    samR1.close()
-    samR2.close()
-
-    print 'Registered {0} fragments'.format(len(frgRegistry))
+    print 'Registered {0} fragments'.format(len(registry))
 
     #
     # Now below we should just build out the graph.
@@ -189,7 +127,7 @@ try:
 
     if args.split_node:
 
-        for frg in frgRegistry.elements():
+        for frg in registry.fragments():
 
             if not frg.isPaired():
                 continue
@@ -198,14 +136,16 @@ try:
 
             for snpR1 in frg.read1.snpSet:
 
+                alleles = registry.alleles(registry.snp_index[SNP.identity(snpR1.vcfRecord)])
+
                 # create ref node
                 # create var node
                 print snpR1, '\n\n'
-                print snpR1.reference, snpR1.alleles[snpR1.reference], "\n\n"
-                print snpR1.variant, snpR1.alleles[snpR1.variant], "\n\n"
+                print snpR1.reference, alleles[snpR1.reference], "\n\n"
+                print snpR1.variant, alleles[snpR1.variant], "\n\n"
 
-                print frg.name in snpR1.alleles[snpR1.reference]
-                print frg.name in snpR1.alleles[snpR1.variant]
+                print frg.name in alleles[snpR1.reference]
+                print frg.name in alleles[snpR1.variant]
                 sys.exit(1)
 
                 for snpR2 in frg.read2.snpSet:
@@ -225,31 +165,32 @@ try:
     else:
 
         # nodes/vertexes
-        for snp in snpRegistry.elements():
+        counts = registry.allele_counts()
+        for snp, (cr, cv) in zip(registry.snps, counts):
             g.add_node(snp)
             g.node[snp]['ref'] = snp.reference
             g.node[snp]['var'] = snp.variant
-            g.node[snp]['ratio'] = snp.ratio
+            g.node[snp]['ratio'] = 0.0 if cv == 0 else float(cv)/float(cr+cv)
             g.node[snp]['qual'] = snp.quality
-            g.node[snp]['depth'] = snp.depth
+            g.node[snp]['depth'] = int(cr + cv)
 
-        # links/edges
-        for frg in frgRegistry.elements():
+        # links/edges, from each pairing of SNPs observed by R1 and R2 of a fragment
+        obs, i, j = registry.linked_observations()
+        snpR1, snpR2 = obs['snp'][i], obs['snp'][j]
 
-            if not frg.isPaired():
-                continue
+        # skip self loops
+        keep = snpR1 != snpR2
+        u = np.minimum(snpR1[keep], snpR2[keep]).astype(np.int64)
+        v = np.maximum(snpR1[keep], snpR2[keep]).astype(np.int64)
 
-            for snpR1 in frg.read1.snpSet:
-                #print '{0} {1}'.format(snpR1, snpR1.weights)
-                for snpR2 in frg.read2.snpSet:
-                    if snpR1 == snpR2:
-                        # skip self loops
-                        continue
-                    #print '\t{0} {1}'.format(snpR2, snpR2.weights)
-                    if g.has_edge(snpR1, snpR2):
-                        g[snpR1][snpR2]['weight'] += 1
-                    else:
-                        g.add_edge(snpR1, snpR2, weight=1)
+        # weight is the number of pairings between two SNPs
+        edges, inv = np.unique(u * len(registry.snps) + v, return_inverse=True)
+        weights = np.bincount(inv, minlength=len(edges))
+        for e, w in zip(edges, weights):
+            u, v = divmod(e, len(registry.snps))
+            g.add_edge(registry.snps[u], registry.snps[v], weight=int(w))
+
+    diagnostics.report('Rejected:')
 
     print "Created {0} nodes".format(g.number_of_nodes())
 
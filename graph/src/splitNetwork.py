@@ -1,10 +1,9 @@
 from hic import *
 import networkx as nx
-import datetime as dt
+import numpy as np
 import os.path
 import argparse
 import logging
-import pysam
 import vcf
 import sys
 
@@ -12,13 +11,6 @@ import sys
 logging.basicConfig(filename='split-network.log', level=logging.DEBUG)
 
 
-#
-# Read base and quality
-#
-def read_base_and_quality(alignedRead, pos):
-    return alignedRead.seq[pos], ord(alignedRead.qual[pos]) - 33
-
-
 #
 # Test for file existence or raise an error
 #
@@ -37,13 +29,65 @@ def add_node(g, id, **kwargs):
         g.add_node(id, kwargs)
 
 
+#
+# Collect the alleles observed by R1 and R2 reads at the variant sites of a contig.
+# The bases and qualities of all reads are extracted together, with the
+# filters applied as masks.
+#
+def collect(registry, diagnostics, contig, positions, snp_ids, sams):
+    ref, var = registry.allele_codes()
+
+    # R1 reads are read end 0 and R2 reads are read end 1
+    for read, sam in enumerate(sams):
+
+        table = site_table(sam, contig, positions, snp_ids)
+        if table is None:
+            continue
+        aln = table['aln']
+        names = table['names']
+
+        # skip secondary alignments and indels
+        secondary = table['secondary'][aln]
+        diagnostics.record('secondary', secondary, lambda k: names[aln[k]], logging.DEBUG)
+        indel = ~secondary & table['indel']
+        diagnostics.record('indel', indel, lambda k: names[aln[k]], logging.DEBUG)
+        rejected = secondary | indel
+
+        # impose minimum quality threshold on basecall and alignment, where bases below
+        # the pileup's threshold are always excluded
+        low_bq = ~rejected & (table['bq'] < max(args.base_quality, PILEUP_MIN_BASE_QUALITY))
+        diagnostics.record('low base quality', low_bq,
+                           lambda k: 'bq={0} {1}'.format(table['bq'][k], names[aln[k]]))
+        rejected |= low_bq
+        low_mq = ~rejected & (table['mapq'][aln] < args.map_quality)
+        diagnostics.record('low mapping quality', low_mq,
+                           lambda k: 'mq={0} {1}'.format(table['mapq'][aln[k]], names[aln[k]]))
+        rejected |= low_mq
+
+        # skip undefined variants
+        is_ref = table['base'] == ref[table['snp']]
+        is_var = table['base'] == var[table['snp']]
+        undefined = ~rejected & ~(is_ref | is_var)
+        diagnostics.record('undefined allele', undefined, lambda k: '{0} was not ref {1} nor alt {2}'.format(
+            chr(table['base'][k]), registry.snp(table['snp'][k]).reference, registry.snp(table['snp'][k]).variant))
+        rejected |= undefined
+
+        # register alleles, placing their fragments
+        for conflict in registry.add_hits(table, ~rejected, is_var, read, contig):
+            diagnostics.count('conflicting placement', lambda: describe_conflict(conflict), logging.WARNING)
+
+
 #
 # User interface
 #
 parser = argparse.ArgumentParser(description='Build snp graph from HiC sequencing data')
-parser.add_argument('-b', '--base_quality', help='Minimum base quality', type=int, default=0)
+parser.add_argument('-b', '--base_quality', help='Minimum base quality, no less than 13', type=int, default=0)
 parser.add_argument('-m', '--map_quality', help='Minimum mapping quality', type=int, default=0)
 parser.add_argument('-v', '--variant_quality', help='Minimum mapping quality', type=int, default=0)
+parser.add_argument('-p', '--processes', help='Number of processes collecting contigs in parallel', type=int,
+                    default=1)
+parser.add_argument('--log-sample', type=float, default=0.0,
+                    help='Fraction of rejected variants and observations to log individually [0]')
 parser.add_argument('vcf_file', help='VCF file of predicted variant sites', metavar='VCF_FILE')
 parser.add_argument('r1_file', help='BAM file for R1 reads', metavar='R1_BAM')
 parser.add_argument('r2_file', help='BAM file for R2 reads', metavar='R2_BAM')
@@ -54,146 +98,51 @@ try:
     # check input files exist
     file_exists([args.vcf_file, args.r1_file, args.r2_file])
 
-    # get the total number of VCF records for progress reporting
-    n_vcf = count_vcf_records(args.vcf_file)
-
     vcfFile = vcf.Reader(filename=args.vcf_file)
-    samR1 = pysam.Samfile(args.r1_file, 'rb')
-    samR2 = pysam.Samfile(args.r2_file, 'rb')
-
-    # Some user-feedback progress reporting variables
-    varCount = 0
-    firstTime = dt.datetime.now()
-    lastTime = firstTime
 
-    # Registry objects for tracking fragments and snps
-    frgRegistry = RegisteredObjectFactory(Fragment)
-    snpRegistry = RegisteredObjectFactory(SNP)
+    # Registry for tracking fragments, snps and the alleles observed by each read
+    registry = AlleleRegistry()
 
+    # counting various things causing rejection
+    diagnostics = Diagnostics(args.log_sample)
 
-    #
-    # Here, we iterate over each variant site and find the pileup column
-    # within R1 and then R2 bam files. For each site, we track Fragments and
-    # there associated reads, as well as the SNP itself.
-    #
-    # These build up a registry of fragments and snps, accessed through object
-    # identity.
-    #
     for variant in vcfFile:
 
         # Skip any variant that isn't a SNP
         if not variant.is_snp:
+            diagnostics.count('not a snp')
             continue
 
         # impose minimum quality on variants. Quality will depend on tool
         # which predicted variant site.
         if variant.QUAL < args.variant_quality:
-            logging.info('%s was below quality threshold: vq=%d', variant, variant.QUAL)
+            diagnostics.count('low variant quality', lambda: '{0} vq={1}'.format(variant, variant.QUAL))
             continue
 
-        # register/get a SNP
+        # register a SNP
         try:
-            snp = snpRegistry.requestObject(vcfRecord=variant)
+            registry.add_snp(variant)
         except Exception as ex:
-            logging.info('Skipping: %s', ex)
+            diagnostics.count('unsupported variant', lambda: str(ex))
             continue
 
-        # Iterate over R1 mapping, looking at the pileup at SNP position
-        for n, col in enumerate(samR1.pileup(reference=snp.contig, start=snp.position-1, end=snp.position, truncate=True)):
-
-            # probably unnecessary, added while trying to understand under-documented API
-            if n > 1:
-                raise Exception('Pileup is assumed to produced only one exact column')
-
-            for pr in col.pileups:
-
-                aln = pr.alignment
-
-                # skip secondary alignments and indels
-                if aln.is_secondary or pr.indel != 0:
-                    logging.debug('Skipped secondary or indel: %s', aln)
-                    continue
-
-                # nucleotide at SNP site for this read.
-                base, bq = read_base_and_quality(aln, pr.qpos)
-                mq = aln.mapq
-
-                # impose minimum quality threshold on basecall and alingment
-                if bq < args.base_quality or mq < args.map_quality:
-                    logging.info('%s was below quality thresholds: bq=%d, mq=%s', base, bq, mq)
-                    continue
-
-                # skip undefined variants
-                if snp.isUndefinedAllele(base):
-                    logging.info('%s was not ref %s nor alt %s', base, snp.reference, snp.variant)
-                    continue
-
-                # Obtain fragment from registry
-                frg = frgRegistry.requestObject(name=aln.qname)
+    varCount = len(registry.snps)
 
-                rpl = ReadPlacement(snp.contig, aln.pos)
-                if not frg.read1:
-                    frg.read1 = rpl
-                elif rpl != frg.read1:
-                    logging.warn('Tried to assign different read placement r1 [%s] to fragment [%s]', rpl, frg)
-
-                # register allele
-                frg.read1.addSnpInstance(snp, base)
-
-        # Now iterate over R2 mapping, looking at the pileup at SNP position
-        for n, col in enumerate(samR2.pileup(reference=snp.contig, start=snp.position-1, end=snp.position, truncate=True)):
-
-            if n > 1:
-                raise Exception('Pileup is assumed to produced only one exact column')
-
-            for pr in col.pileups:
-
-                aln = pr.alignment
-
-                # skip secondary alignments and indels
-                if aln.is_secondary or pr.indel != 0:
-                    logging.debug('Skipped secondary or indel: %s', aln)
-                    continue
-
-                base, bq = read_base_and_quality(aln, pr.qpos)
-                mq = aln.mapq
-
-                # impose minimum quality threshold on basecall and alingment
-                if bq < args.base_quality or mq < args.map_quality:
-                    logging.info('%s was below quality thresholds: bq=%d, mq=%s', base, bq, mq)
-                    continue
-
-                # skip undefined variants
-                if snp.isUndefinedAllele(base):
-                    logging.info('%s was not ref %s nor alt %s', base, snp.reference, snp.variant)
-                    continue
-
-                # Obtain fragment from registry
-                frg = frgRegistry.requestObject(name=aln.qname)
-
-                rpl = ReadPlacement(snp.contig, aln.pos)
-                if not frg.read2:
-                    frg.read2 = rpl
-                elif rpl != frg.read2:
-                    logging.warn('Tried to assign different read placement r2 [%s] to fragment [%s]', rpl, frg)
-
-                # register allele
-                frg.read2.addSnpInstance(snp, base)
-
-        varCount += 1
-        if varCount % 100 == 0:
-            curTime = dt.datetime.now()
-            ta = (curTime - lastTime)
-            tb = (curTime - firstTime)
-            print "... processed {0}/{1} variants in {2} walltime: {3}".format(varCount, n_vcf, ta, tb)
-            lastTime = curTime
+    #
+    # Here, we visit the variant sites contig by contig, walking the R1 and
+    # then R2 bam files once for each contig. Each read reports the bases
+    # it holds at all of the sites it covers. For each site, we track Fragments
+    # and their associated reads, as well as the SNP itself. Contigs may be
+    # collected by parallel processes.
+    #
+    # These build up a registry of fragments and snps, accessed through object
+    # identity.
+    #
+    collect_alleles(registry, collect, [args.r1_file, args.r2_file], args.processes, diagnostics)
 
     print 'Finished reading data, {0} variants'.format(varCount)
 
-    samR1.close()
-    samR2.close()
-
-    print 'Registered {0} fragments'.format(len(frgRegistry))
+    print 'Registered {0} fragments'.format(len(registry))
 
     #
     # Now we just build the graph.
@@ -203,65 +152,59 @@ try:
     # accumulated fragment count.
     #
 
-    # counting various things causing rejection
-    rejCount = {'contradictory': 0, 'self-loop': 0, 'unpaired': 0}
-
     # empty graph
     g = nx.Graph(type='split', version=1)
 
-    # iterate over all fragments in registry
-    for frg in frgRegistry.elements():
+    diagnostics.record('unpaired', ~registry.is_paired(), lambda k: registry.frag_names[k])
 
-        if not frg.isPaired():
-            rejCount['unpaired'] += 1
-            continue
+    # all pairings of a SNP instance of R1 with a SNP instance of R2, across all fragments.
+    # Nodes are identified by SNP id and allele as snp_id*2 + allele.
+    obs, i, j = registry.linked_observations()
+    snpR1, snpR2 = obs['snp'][i], obs['snp'][j]
+    nodeR1 = snpR1.astype(np.int64) * 2 + obs['allele'][i]
+    nodeR2 = snpR2.astype(np.int64) * 2 + obs['allele'][j]
+
+    # Skipping self loops, often occurring if read pairs overlap
+    self_loop = snpR1 == snpR2
+
+    def describe_loop(k):
+        snp = registry.snps[snpR1[k]]
+        baseR1 = snp.variant if nodeR1[k] % 2 else snp.reference
+        baseR2 = snp.variant if nodeR2[k] % 2 else snp.reference
+        return 'R1/R2 {0}/{1} at an overlapping SNP position {2}'.format(baseR1, baseR2, snp)
 
-        # iterate over all SNPs contained within a fragment
-        # nested loops as this is n-way.
-        for snpR1, baseR1 in frg.read1.snpInstances.iteritems():
-
-            # TODO: labels should be generated in class, this is really a form of object identity
-            u = '{0}.{1}'.format(snpR1, baseR1)  # origin
-
-            for snpR2, baseR2 in frg.read2.snpInstances.iteritems():
-
-
-                # TODO: ditto above
-                v = '{0}.{1}'.format(snpR2, baseR2)  # destination
-
-                # Skipping self loops, often occurring if read pairs overlap
-                if snpR1 == snpR2:
-                    # just interesting to capture contradictions info.
-                    if baseR1 != baseR2:
-                        logging.warn('Contradictory bases for R1/R2 {0}/{1} at an overlapping SNP position {2}'.format(
-                            baseR1, baseR2, snpR1))
-                        rejCount['contradictory'] += 1
-                        continue
-                    else:
-                        logging.warn('Self-loop for R1/R2 {0}/{1} at an overlapping SNP position {2}'.format(
-                            baseR1, baseR2, snpR1))
-                        rejCount['self-loop'] += 1
-                        continue
-
-                #
-                # WEIGHTING!
-                #
-                # Weights by simple occurrence
-                #
-                if g.has_edge(u, v):
-                    # add one to edge
-                    g[u][v]['weight'] += 1
-                else:
-                    # pre-create nodes so we can add some attributes
-                    # TODO: add more or more pertinent attributes.
-                    add_node(g, u, quality=snpR1.quality)
-                    add_node(g, v, quality=snpR2.quality)
-                    # new edge
-                    g.add_edge(u, v, weight=1)
+    # just interesting to capture contradictions info.
+    contradictory = self_loop & (nodeR1 != nodeR2)
+    diagnostics.record('contradictory', contradictory, describe_loop, logging.WARNING)
+    diagnostics.record('self-loop', self_loop & ~contradictory, describe_loop, logging.WARNING)
 
+    #
+    # WEIGHTING!
+    #
+    # Weights by simple occurrence
+    #
+    u = np.minimum(nodeR1[~self_loop], nodeR2[~self_loop])
+    v = np.maximum(nodeR1[~self_loop], nodeR2[~self_loop])
+    n_nodes = 2 * len(registry.snps)
+    edges, inv = np.unique(u * n_nodes + v, return_inverse=True)
+    weights = np.bincount(inv, minlength=len(edges))
+
+    # TODO: labels should be generated in class, this is really a form of object identity
+    def node_label(node):
+        snp = registry.snps[node // 2]
+        return '{0}.{1}'.format(snp, snp.variant if node % 2 else snp.reference), snp
+
+    for e, w in zip(edges, weights):
+        u, snpU = node_label(e // n_nodes)
+        v, snpV = node_label(e % n_nodes)
+        # pre-create nodes so we can add some attributes
+        # TODO: add more or more pertinent attributes.
+        add_node(g, u, quality=snpU.quality)
+        add_node(g, v, quality=snpV.quality)
+        g.add_edge(u, v, weight=int(w))
 
     print "Created {0} nodes".format(g.number_of_nodes())
-    print 'Rejected snp instances: {0}'.format(rejCount)
+    diagnostics.report('Rejected:')
     nx.write_graphml(g, args.output)
 
 except Exception as e:
@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 import argparse
+import hashlib
 import pysam
 import numpy as np
 import networkx as nx
 import community as com
 import math
+import multiprocessing as mp
+import os
 import sys
 from Bio import SeqIO
 from Bio.Restriction import RestrictionBatch
 from scipy.misc import factorial
 from scipy.stats import poisson
+from scipy.special import gammaln
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 from scipy.stats import geom
+from collections import deque, namedtuple
+from itertools import chain
 
 # use matplotlib without x-server
 #import matplotlib as mpl
@@ -18,26 +25,6 @@ from scipy.stats import geom
 import matplotlib.pyplot as plt
 
 
-import yaml
-from collections import OrderedDict
-def order_rep(dumper, data):
-    return dumper.represent_mapping(u'tag:yaml.org,2002:map', data.items(), flow_style=False)
-yaml.add_representer(OrderedDict, order_rep)
-
-
-def dump_pairs(filename, pairs):
-    print 'Dumping pairs to {0}'.format(filename)
-    with open(filename, 'w') as out_h:
-        # convert numpy int32 to int, yaml chokes otherwise
-        ndict = {}
-        for rn, reads in pairs.iteritems():
-            ndict[rn] = {}
-            for k, places in reads.iteritems():
-                ndict[rn][k] = map(int, places)  # non-py3
-        od = OrderedDict(sorted(ndict.items()))
-        yaml.dump(od, out_h)
-
-
 def inverse_edge_weights(g):
     for u, v in g.edges():
         g.edge[u][v]['weight'] = 1.0/g[u][v]['weight']
@@ -101,6 +88,24 @@ def decompose_graph(g):
 
     return decomposed
 
+# separation (bp) beyond which the GRAAL contact probability is a constant minimum
+GRAAL_MAX_SEPARATION = 3e6
+GRAAL_MIN_RATE = 1.0e-8
+
+
+def graal_contact_rate(d):
+    """
+    Piece-wise continuous function defined in GRAAL, relating separation distance to
+    the probability of a contact. Above a certain separation distance, the probability
+    reaches a constant minimum value.
+
+    :param d: array of separation distances in base-pairs
+    :return: array of contact probabilities
+    """
+    return np.where(d < GRAAL_MAX_SEPARATION,
+                    0.5*(1.0 / GRAAL_MAX_SEPARATION - (1. - 6e-6)**d * np.log(1.0 - 6e-6)),
+                    np.where(d > GRAAL_MAX_SEPARATION, GRAAL_MIN_RATE, 0.0))
+
 """
 Simulator reads have 'fwd' and 'rev' appended to their pair names
 """
@@ -218,100 +223,256 @@ class Grouping:
     # masked bit
     MASK = -1
 
-    def __init__(self, site_list, bin_width, min_sites):
-        total_sites = 0
-        self.bins = []
-        self.map = []
+    def __init__(self, site_list, bin_width, min_sites, quiet=False):
+        """
+        Group the restriction sites of each sequence into bins of approximately bin_width
+        adjacent sites. All sequences are handled at once, over the concatenation of their
+        site positions.
+
+        :param site_list: list of sites per sequence, as from DigestedSequence.digestion_sites
+        :param bin_width: number of adjacent sites per bin
+        :param min_sites: sequences with a single bin of fewer sites are masked
+        :param quiet: do not report the binning of each sequence
+        """
         self.bin_width = bin_width
         self.min_sites = min_sites
 
-        for seq_sites in site_list:
-
-            max_n = len(seq_sites['pos'])
-
-            if max_n == 0:
-                # Sequences which had no sites get empty place holders
-                # this maintains order of lists
-                self.bins.append(Grouping.MASK)
+        n_seq = len(site_list)
+        n_sites = np.array([len(seq_sites['pos']) for seq_sites in site_list], dtype=np.int64)
+        positions = np.fromiter(chain.from_iterable(seq_sites['pos'] for seq_sites in site_list),
+                                dtype=np.int64, count=np.sum(n_sites))
+
+        # required bins is the quotient, but the least number of bins is 1.
+        # add an extra bin when there is a sufficient number of left-overs
+        # but do not split a single bin sequence.
+        self.bins = np.where(n_sites >= bin_width, n_sites // bin_width, 1)
+        self.bins += (n_sites > bin_width) & ((n_sites % bin_width).astype(np.float64) / bin_width >= 0.5)
+
+        # Sequences which had no sites, or too few, get empty place holders.
+        # this maintains order of lists
+        low_sites = (n_sites > 0) & (self.bins == 1) & (n_sites < min_sites)
+        self.bins[(n_sites == 0) | low_sites] = Grouping.MASK
+        self.total = np.sum(n_sites[self.bins != Grouping.MASK])
+
+        # starting with integer indices, apply a scale factor to adjust
+        # them matching the desired binning. The integer part is then
+        # the (0-based) bin membership
+        site_seq = np.repeat(np.arange(n_seq), n_sites)
+        site_start = np.cumsum(n_sites) - n_sites
+        local_idx = np.arange(len(positions)) - site_start[site_seq]
+        grp = np.floor(local_idx * self.bins[site_seq].astype(np.float64) / n_sites[site_seq]).astype(np.int64)
+        site_map = np.column_stack((positions, grp))
+
+        # offset of each sequence's bins in the map, masked sequences occupy no bins
+        seq_bins = np.clip(self.bins, 0, None)
+        self.offsets = np.cumsum(seq_bins) - seq_bins
+
+        # calculate centers of each fragment groupings, as the mean over both columns
+        # (position and bin) of each bin's rows in the map. This will be used when
+        # measuring separation.
+        kept = self.bins[site_seq] != Grouping.MASK
+        global_bin = self.offsets[site_seq[kept]] + grp[kept]
+        n_bins = np.sum(seq_bins)
+        self.bin_center = np.bincount(global_bin, weights=positions[kept] + grp[kept], minlength=n_bins) / \
+            (2 * np.bincount(global_bin, minlength=n_bins))
+
+        # per sequence views
+        self.map = []
+        self.site_index = []
+        self.centers = []
+        for n in xrange(n_seq):
+            if self.bins[n] == Grouping.MASK:
                 self.map.append(None)
-                continue
-
-            # required bins is the quotient, but the least number
-            # of bins is 1.
-            required_bins = max_n / bin_width if max_n >= bin_width else 1
-            if max_n > bin_width and float(max_n % bin_width)/bin_width >= 0.5:
-                # add an extra bin when there is a sufficient number of left-overs
-                # but do not split a single bin sequence.
-                required_bins += 1
+                self.site_index.append(None)
+                self.centers.append(None)
+            else:
+                self.map.append(site_map[site_start[n]:site_start[n] + n_sites[n]])
+                # sorted site positions for nearest-site queries
+                self.site_index.append(positions[site_start[n]:site_start[n] + n_sites[n]])
+                self.centers.append(self.bin_center[self.offsets[n]:self.offsets[n] + self.bins[n]])
+
+        if not quiet:
+            for n in xrange(n_seq):
+                if low_sites[n]:
+                    print '\tSequence had only {0} sites, which is less ' \
+                          'than the minimum threshold {1}'.format(n_sites[n], min_sites)
+                elif self.bins[n] != Grouping.MASK:
+                    print '\t{0} sites in {1} bins. Bins: {2}'.format(n_sites[n], self.bins[n],
+                                                                      np.bincount(self.map[n][:, 1]))
 
-            if required_bins == 1 and max_n < min_sites:
-                self.bins.append(Grouping.MASK)
-                self.map.append(None)
-                print '\tSequence had only {0} sites, which is less ' \
-                      'than the minimum threshold {1}'.format(required_bins, min_sites)
-                continue
+    def total_bins(self):
+        mask_bins = np.ma.masked_equal(self.bins, Grouping.MASK)
+        return np.ma.sum(mask_bins)
 
+    def find_nearest(self, ctg_idx, x, above=True):
+        """
+        Find the nearest site either above or below a position on a sequence.
 
-            # starting with integer indices, apply a scale factor to adjust
-            # them matching the desired binning. This can then be digitised
-            # to determine bin membership
-            sclidx = np.arange(max_n, dtype=np.int32) * float(required_bins)/max_n
+        :param ctg_idx: sequence index
+        :param x: position on the sequence
+        :param above: True - nearest site at or above x, False - nearest site at or below x
+        :return: row of the grouping map (site, bin)
+        """
+        group_map = self.map[ctg_idx]
+        sites = self.site_index[ctg_idx]
+        if above:
+            if x > sites[-1]:
+                raise RuntimeError('No site above {0}, largest was {1}'.format(x, sites[-1]))
+            idx = np.searchsorted(sites, x, side='left')
+        else:
+            if x < sites[0]:
+                raise RuntimeError('No site before {0}, smallest was {1}'.format(x, sites[0]))
+            idx = np.searchsorted(sites, x, side='right') - 1
+            # of coincident sites, prefer the first
+            idx = np.searchsorted(sites, sites[idx], side='left')
+        return group_map[idx, :]
 
-            # determine bin membership, but subtract one from each to get 0-based
-            grp = np.digitize(sclidx, np.arange(required_bins)) -1
+    def find_nearest_bins(self, ctg_idx, x, above):
+        """
+        Bulk form of find_nearest. For an array of positions on a single sequence, find the bin
+        of the nearest site above or below each position. Positions for which no site exists in
+        the requested direction are reported as invalid rather than raising an error.
+
+        :param ctg_idx: sequence index
+        :param x: array of positions on the sequence
+        :param above: array of booleans (or a single boolean), True where the nearest site above is wanted
+        :return: tuple (bins, valid), where bins are only meaningful where valid is True
+        """
+        group_map = self.map[ctg_idx]
+        sites = self.site_index[ctg_idx]
+        x = np.asarray(x)
+        above = np.broadcast_to(np.asarray(above, dtype=np.bool), x.shape)
 
-            self.bins.append(required_bins)
-            self.map.append(np.column_stack((seq_sites['pos'], grp)))
+        idx_above = np.searchsorted(sites, x, side='left')
+        idx_below = np.searchsorted(sites, x, side='right') - 1
+        valid = np.where(above, idx_above < len(sites), idx_below >= 0)
 
-            total_sites += max_n
+        # of coincident sites, prefer the first
+        idx_below = np.searchsorted(sites, sites[np.clip(idx_below, 0, len(sites) - 1)], side='left')
+        idx = np.where(above, idx_above, idx_below)
+        idx[~valid] = 0
+        return group_map[idx, 1], valid
 
-            print '\t{0} sites in {1} bins. Bins: {2}'.format(max_n, required_bins, np.bincount(grp))
 
-        self.bins = np.array(self.bins)
+class FragmentGrouping(Grouping):
 
-        self.total = total_sites
+    def __init__(self, site_list, lengths, min_sites, quiet=False):
+        """
+        Exact restriction fragment resolution. Each sequence is cut at its sites and every fragment,
+        including those from either end of the sequence to the first and last site, forms its own bin.
+        The grouping map lists the start of each fragment alongside its bin.
+
+        :param site_list: list of sites per sequence, as from DigestedSequence.digestion_sites
+        :param lengths: length of each sequence
+        :param min_sites: sequences with fewer sites are masked
+        :param quiet: do not report the fragments of each sequence
+        """
+        self.bin_width = 1
+        self.min_sites = min_sites
 
-        # calculate centers of each fragment groupings. This will be used
-        # when measuring separation.
+        n_seq = len(site_list)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        seq_sites = np.array([len(s['pos']) for s in site_list], dtype=np.int64)
+        positions = np.fromiter(chain.from_iterable(s['pos'] for s in site_list),
+                                dtype=np.int64, count=np.sum(seq_sites))
+        site_seq = np.repeat(np.arange(n_seq), seq_sites)
+
+        # sites of an enzyme cocktail can coincide, these would only produce empty fragments
+        keep = np.ones(len(positions), dtype=np.bool)
+        keep[1:] = (positions[1:] != positions[:-1]) | (site_seq[1:] != site_seq[:-1])
+        n_sites = np.bincount(site_seq[keep], minlength=n_seq)
+
+        masked = (n_sites == 0) | (n_sites < min_sites)
+        self.bins = np.where(masked, Grouping.MASK, n_sites + 1)
+        self.total = np.sum(n_sites[~masked])
+
+        # distinct sites of unmasked sequences
+        keep &= ~masked[site_seq]
+        positions = positions[keep]
+        site_seq = site_seq[keep]
+        kept_sites = np.where(masked, 0, n_sites)
+        site_start = np.cumsum(kept_sites) - kept_sites
+        kept_seq = np.flatnonzero(~masked)
+
+        # fragment boundaries, each sequence's sites bracketed by its beginning and end
+        starts = np.insert(positions, site_start[kept_seq], 0)
+        ends = np.insert(positions, site_start[kept_seq] + kept_sites[kept_seq], lengths[kept_seq])
+
+        seq_bins = np.clip(self.bins, 0, None)
+        self.offsets = np.cumsum(seq_bins) - seq_bins
+        self.bin_center = 0.5 * (starts + ends)
+        frag_seq = np.repeat(np.arange(n_seq), seq_bins)
+        site_map = np.column_stack((starts, np.arange(len(starts)) - self.offsets[frag_seq]))
+
+        # per sequence views
+        self.map = []
+        self.site_index = []
         self.centers = []
-        for n, num_bins in enumerate(self.bins):
-            if num_bins == Grouping.MASK:
+        for n in xrange(n_seq):
+            if masked[n]:
+                self.map.append(None)
+                self.site_index.append(None)
                 self.centers.append(None)
             else:
-                self.centers.append(np.array([
-                    np.mean(self.map[n][np.where(self.map[n][:, 1] == i)]) for i in xrange(num_bins)]))
-
-    def total_bins(self):
-        mask_bins = np.ma.masked_equal(self.bins, Grouping.MASK)
-        return np.ma.sum(mask_bins)
+                self.map.append(site_map[self.offsets[n]:self.offsets[n] + self.bins[n]])
+                self.site_index.append(positions[site_start[n]:site_start[n] + kept_sites[n]])
+                self.centers.append(self.bin_center[self.offsets[n]:self.offsets[n] + self.bins[n]])
+
+        if not quiet:
+            for n in xrange(n_seq):
+                if masked[n] and n_sites[n] > 0:
+                    print '\tSequence had only {0} sites, which is less ' \
+                          'than the minimum threshold {1}'.format(n_sites[n], min_sites)
+                elif not masked[n]:
+                    print '\t{0} sites in {1} fragments'.format(n_sites[n], self.bins[n])
 
     def find_nearest(self, ctg_idx, x, above=True):
-        # TODO this is very slow! Masked arrays have a severe penalty, therefore
-        # need to do this another way. The bounds checking here is no faster than
-        # testing the masked array for "all masked".
-        group_map = self.map[ctg_idx]
-        if above:
-            if x > group_map[-1, 0]:
-                raise RuntimeError('No site above {0}, largest was {1}'.format(x, group_map[-1, 0]))
-            diff = group_map[:, 0] - x
-        else:
-            if x < group_map[0, 0]:
-                raise RuntimeError('No site before {0}, smallest was {1}'.format(x, group_map[0, 0]))
-            diff = x - group_map[:, 0]
+        """
+        Find the fragment containing a read whose 5' end is at x. Reads mapped in reverse
+        are given by their (exclusive) end and so lie upon the fragment containing x-1.
 
-        # mask any value less than zero and then find the smallest argument.
-        masked_diff = np.ma.masked_less(diff, 0)
-        idx = masked_diff.argmin()
-        return group_map[idx, :]
+        :param ctg_idx: sequence index
+        :param x: position on the sequence
+        :param above: True - read was mapped forward, False - in reverse
+        :return: row of the grouping map (fragment start, bin)
+        """
+        bins, valid = self.find_nearest_bins(ctg_idx, np.array([x]), above)
+        return self.map[ctg_idx][bins[0], :]
+
+    def find_nearest_bins(self, ctg_idx, x, above):
+        """
+        Bulk form of find_nearest. Every position lies upon some fragment, so all are valid.
+
+        :param ctg_idx: sequence index
+        :param x: array of positions on the sequence
+        :param above: array of booleans (or a single boolean), True where the read was mapped forward
+        :return: tuple (bins, valid)
+        """
+        x = np.asarray(x)
+        above = np.broadcast_to(np.asarray(above, dtype=np.bool), x.shape)
+        bins = np.searchsorted(self.site_index[ctg_idx], np.where(above, x, x - 1), side='right')
+        return bins, np.ones(x.shape, dtype=np.bool)
 
 
-class SeqOrder:
+"""
+A local rearrangement of the order. Order positions [start, stop) are replaced by the listed segments,
+each given as (seg_start, seg_stop, flip) in present order positions. Flipped segments are inverted,
+both their order and the orientation of each member is reversed.
+"""
+Move = namedtuple('Move', ['start', 'stop', 'segments'])
+
+
+class SeqOrder(object):
 
     def __init__(self, seq_list, site_list):
         """
         Order is initially determined by the order of supplied sequence list. Indices of sequences
         which possessed no restriction sites are indicated in "no_sites".
 
+        Alongside the order, the inverse permutation (the position of each sequence within the order)
+        and the cumulative length of sequences by order position are maintained. This permits
+        constant time position comparisons and intervening length queries.
+
         :param seq_list: list of sequences
         :param site_list: list of re-sites per sequence.
         """
@@ -319,6 +480,95 @@ class SeqOrder:
         self.lengths = np.array([len(seq['record']) for seq in seq_list if not seq['excluded']])
         self.order = np.arange(len(self.names))
         self.no_sites = np.array([len(site['pos']) == 0 for site in site_list])
+        # orientation of each sequence, True when reverse complemented
+        self.reversed = np.zeros(len(self.names), dtype=np.bool)
+
+    @property
+    def order(self):
+        return self._order
+
+    @order.setter
+    def order(self, new_order):
+        self._order = np.array(new_order)
+        self.position = np.empty(len(self._order), dtype=np.int64)
+        self.cum_length = np.zeros(len(self._order) + 1, dtype=np.int64)
+        self.update_positions()
+
+    def update_positions(self, start=0, stop=None):
+        """
+        Update the inverse permutation and cumulative lengths after the order has been
+        changed in place. Only the order positions [start, stop) are revisited, therefore
+        changes local to a block of the order can be reflected cheaply.
+
+        :param start: first order position which changed
+        :param stop: one past the last order position which changed, None for the end of the order
+        """
+        if stop is None:
+            stop = len(self._order)
+        _block = self._order[start:stop]
+        self.position[_block] = np.arange(start, stop)
+        self.cum_length[start+1:stop+1] = self.cum_length[start] + np.cumsum(self.lengths[_block])
+
+    @staticmethod
+    def swap_move(a, b):
+        """
+        Exchange the sequences at order positions a and b.
+        :return: Move
+        """
+        if a > b:
+            a, b = b, a
+        if b - a == 1:
+            return Move(a, b+1, [(b, b+1, False), (a, a+1, False)])
+        return Move(a, b+1, [(b, b+1, False), (a+1, b, False), (a, a+1, False)])
+
+    @staticmethod
+    def shift_move(a, b):
+        """
+        Remove the sequence at order position a and reinsert it so that it resides at position b.
+        :return: Move
+        """
+        if a < b:
+            return Move(a, b+1, [(a+1, b+1, False), (a, a+1, False)])
+        return Move(b, a+1, [(a, a+1, False), (b, a, False)])
+
+    @staticmethod
+    def reverse_move(a, b):
+        """
+        Reverse the order of the sequences at positions a to b (inclusive), leaving the
+        orientation of each unchanged.
+        :return: Move
+        """
+        if a > b:
+            a, b = b, a
+        return Move(a, b+1, [(i, i+1, False) for i in xrange(b, a-1, -1)])
+
+    @staticmethod
+    def flip_move(a, b=None):
+        """
+        Invert the block of sequences at positions a to b (inclusive). Both the order and orientation
+        of each sequence are reversed. When b is not given, only the orientation of a is changed.
+        :return: Move
+        """
+        if b is None:
+            b = a
+        elif a > b:
+            a, b = b, a
+        return Move(a, b+1, [(a, b+1, True)])
+
+    def apply_move(self, move):
+        """
+        Rearrange the order in place according to a Move.
+        :param move: the Move to apply
+        """
+        new_block = []
+        for seg_start, seg_stop, flip in move.segments:
+            seg = self._order[seg_start:seg_stop]
+            if flip:
+                seg = seg[::-1]
+                self.reversed[seg] = ~self.reversed[seg]
+            new_block.append(seg)
+        self._order[move.start:move.stop] = np.concatenate(new_block)
+        self.update_positions(move.start, move.stop)
 
     def is_first(self, a, b):
         """
@@ -327,9 +577,7 @@ class SeqOrder:
         :param b: another sequence in order
         :return: True if a comes before b
         """
-        ia = np.argwhere(self.order == a)
-        ib = np.argwhere(self.order == b)
-        return ia < ib
+        return self.position[a] < self.position[b]
 
     def intervening(self, a, b):
         """
@@ -340,11 +588,11 @@ class SeqOrder:
         :param b: second sequence
         :return: total length of sequences currently between A and B in the order.
         """
-        ia = np.argwhere(self.order == a)
-        ib = np.argwhere(self.order == b)
+        ia = self.position[a]
+        ib = self.position[b]
         if ia > ib:
             ia, ib = ib, ia
-        return np.sum(self.lengths[self.order[ia+1:ib]])
+        return self.cum_length[ib] - self.cum_length[ia+1]
 
     @staticmethod
     def initial_ordering_from_file(fasta_file):
@@ -363,10 +611,27 @@ class FragmentMap:
     def active_len(self):
         return np.sum(self.order.lengths)
 
-    def __init__(self, bam_file, fasta_file, enzyme, min_sites=1, bin_width=3, simu_reads=False):
+    # layout of the per-read observations gathered from the BAM file
+    PAIR_DTYPE = np.dtype([('frag', np.int64), ('rdir', np.bool), ('bin', np.int64)])
 
+    def __init__(self, bam_file, fasta_file, enzyme, min_sites=1, bin_width=3, simu_reads=False, cache_dir=None,
+                 quiet=False, per_fragment=False):
+        """
+        :param bam_file: BAM file of HiC reads mapped to the sequences
+        :param fasta_file: sequences in FASTA format
+        :param enzyme: enzyme used in the HiC restriction digest, or a list of enzymes for a cocktail
+        :param min_sites: minimum number of sites for a sequence to be binned
+        :param bin_width: number of adjacent sites per bin
+        :param simu_reads: reads were generated by the simulator
+        :param cache_dir: directory in which pairs and the contact map are cached, None to disable caching
+        :param quiet: do not report per-sequence details
+        :param per_fragment: bin at the resolution of individual restriction fragments, ignoring bin_width.
+        Only the sparse map is kept, the dense raw_map is not created.
+        """
         min_length = 1000
-        self.bin_width = bin_width
+        self.enzymes = [enzyme] if isinstance(enzyme, basestring) else sorted(enzyme)
+        self.per_fragment = per_fragment
+        self.bin_width = 1 if per_fragment else bin_width
         self.min_sites = min_sites
         self.simu_reads = simu_reads
 
@@ -379,41 +644,98 @@ class FragmentMap:
                     excluded = True
                 seq_list.append({'record': seq, 'excluded': excluded})
 
-            print 'Digesting supplied sequences with {0} ...'.format(enzyme)
-            self.sites = DigestedSequence.digestion_sites(seq_list, [enzyme], 5)
+            print 'Digesting supplied sequences with {0} ...'.format(', '.join(self.enzymes))
+            self.sites = DigestedSequence.digestion_sites(seq_list, self.enzymes, 5)
 
             print 'Initializing sequence order ...'
             self.order = SeqOrder(seq_list, self.sites)
 
-        with pysam.AlignmentFile(bam_file, 'rb') as self.bam:
-            print 'Analyzing BAM file ...'
-            #self.active_seq = len(self.bam.references)
-            #self.active_len = sum(self.bam.lengths)
-            self.total_reads = self.bam.count()
-
-            print '\tMap based upon mapping containing:\n' \
-                  '\t{0} sequences\n' \
-                  '\t{1}bp total length\n' \
-                  '\t{2} mapped reads'.format(self.active_seq, self.active_len, self.total_reads)
-
+        if per_fragment:
+            print 'Binning individual restriction fragments ...'
+            self.groupings = FragmentGrouping(self.sites, self.order.lengths, self.min_sites, quiet=quiet)
+        else:
             print 'Binning restriction sites into groups of approximately {0} ...'.format(bin_width)
-            self.groupings = Grouping(self.sites, self.bin_width, self.min_sites)
+            self.groupings = Grouping(self.sites, self.bin_width, self.min_sites, quiet=quiet)
+
+        print 'Map details:\n' \
+              '\t{0} adjacent fragments per bin\n' \
+              '\t{1} total sites\n' \
+              '\t{2}x{2} matrix'.format(self.bin_width, self.groupings.total, self.groupings.total_bins())
+
+        self.raw_map = None
+        self.sparse_map = None
+        self.norm_map = None
+        self.pairs = None
+
+        # per-bin tables and observed contacts used in likelihood calculation,
+        # these are initialised on first use.
+        self.bin_seq = None
+        self.bin_center = None
+        self._contacts = None
+
+        cache_file = None
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            cache_file = os.path.join(cache_dir, 'fragmap_{0}.npz'.format(
+                FragmentMap.cache_key(bam_file, fasta_file, self.enzymes, min_sites, self.bin_width, simu_reads,
+                                      per_fragment)))
+
+        if cache_file is not None and os.path.exists(cache_file):
+            print 'Loading pairs and contact map from cache {0} ...'.format(cache_file)
+            self._load_cache(cache_file)
 
-            print 'Map details:\n' \
-                  '\t{0} adjacent fragments per bin\n' \
-                  '\t{1} total sites\n' \
-                  '\t{2}x{2} matrix'.format(self.bin_width, self.groupings.total_bins(), self.groupings.total_bins())
+        else:
+            with pysam.AlignmentFile(bam_file, 'rb') as self.bam:
+                print 'Analyzing BAM file ...'
+                self.total_reads = self.bam.count()
 
-            self.raw_map = None
-            self.norm_map = None
-            self.pairs = {}
+                print '\tMap based upon mapping containing:\n' \
+                      '\t{0} sequences\n' \
+                      '\t{1}bp total length\n' \
+                      '\t{2} mapped reads'.format(self.active_seq, self.active_len, self.total_reads)
 
-            # process open BAM file and initialise pairs dictionary
-            self._build_pairs()
+                # process open BAM file and initialise pairs
+                self._build_pairs()
 
             # using initialized pairs, populate the contact matrix
             self._calculate_map()
 
+            if cache_file is not None:
+                print 'Caching pairs and contact map to {0} ...'.format(cache_file)
+                self._save_cache(cache_file)
+
+    @staticmethod
+    def cache_key(bam_file, fasta_file, enzymes, min_sites, bin_width, simu_reads, per_fragment):
+        """
+        A key identifying the inputs and parameters which determine pairs and the contact map.
+        Input files are identified by path, size and modification time.
+        :return: hex digest
+        """
+        def file_id(fn):
+            st = os.stat(fn)
+            return os.path.abspath(fn), st.st_size, int(st.st_mtime)
+        key = repr((file_id(bam_file), file_id(fasta_file), enzymes, min_sites, bin_width, simu_reads, per_fragment))
+        return hashlib.md5(key).hexdigest()
+
+    def _save_cache(self, cache_file):
+        m = self.sparse_map
+        np.savez(cache_file, total_reads=self.total_reads, pairs=self.pairs,
+                 map_row=m.row, map_col=m.col, map_data=m.data, map_shape=m.shape)
+
+    def _load_cache(self, cache_file):
+        cache = np.load(cache_file)
+        n_bins = self.groupings.total_bins()
+        if tuple(cache['map_shape']) != (n_bins, n_bins):
+            raise RuntimeError('Cached map {0} does not match the present binning of {1} bins'.format(
+                cache_file, n_bins))
+        self.total_reads = int(cache['total_reads'])
+        self.pairs = cache['pairs']
+        self.sparse_map = coo_matrix((cache['map_data'], (cache['map_row'], cache['map_col'])), shape=(n_bins, n_bins))
+        if not self.per_fragment:
+            self.raw_map = self.sparse_map.toarray()
+        print 'Total raw map weight {0}'.format(np.sum(self.sparse_map.data))
+
     def set_order(self, new_order):
         self.order.order = np.array(new_order)
 
@@ -441,39 +763,143 @@ class FragmentMap:
             _order[i] = shuf[n]
             n += 1
 
-    def create_contig_graph(self):
+        self.order.update_positions()
+
+    def contig_contacts(self):
+        """
+        Total contacts shared between each pair of sequences, aggregated from the sparse map
+        by the sequence to which each bin belongs. Only observed pairs are present.
+
+        :return: coo_matrix of sequence x sequence contacts, upper triangle only
+        """
+        contacts = self._inter_contacts()
+        n_seq = len(self.order.names)
+        # as the map is upper triangular and bins are grouped by sequence, rows precede cols
+        cc = coo_matrix((contacts['counts'], (self.bin_seq[contacts['rows']], self.bin_seq[contacts['cols']])),
+                        shape=(n_seq, n_seq))
+        cc.sum_duplicates()
+        return cc
+
+    def _contig_edges(self, complete=False, pseudo_count=1):
+        """
+        Edges of the contig graph, weighted by the cumulative weight of contacts shared
+        between contigs, normalized by the product of the number of fragments involved.
+        Each pair of bins is credited with a pseudo-count, which is added analytically
+        to the total.
+
+        :param complete: link every pair of contigs which have sites
+        :param pseudo_count: pseudo-count per pair of bins
+        :return: tuple of arrays (contig i, contig j, weight)
+        """
+        _bins = self.groupings.bins
+        n_sites = np.array([0 if m is None else len(m) for m in self.groupings.map])
+        cc = self.contig_contacts()
+
+        if complete:
+            _seq = np.flatnonzero(_bins != Grouping.MASK)
+            ii, jj = np.triu_indices(len(_seq), 1)
+            ii, jj = _seq[ii], _seq[jj]
+            contacts = np.asarray(cc.tocsr()[ii, jj]).ravel()
+        else:
+            ii, jj, contacts = cc.row, cc.col, cc.data
+
+        w = (contacts + pseudo_count * _bins[ii] * _bins[jj]) / (n_sites[ii] * n_sites[jj]).astype(np.float64)
+        return ii, jj, w
+
+    def create_contig_graph(self, complete=False, pseudo_count=1):
         """
         Create a graph where contigs are nodes and edges linking
         nodes are weighted by the cumulative weight of contacts shared
         between them, normalized by the product of the number of fragments
         involved.
 
+        Only pairs of contigs with observed contacts are linked, unless a
+        complete graph is requested.
+
+        :param complete: link every pair of contigs which have sites
+        :param pseudo_count: pseudo-count per pair of bins
         :return: graph of contigs
         """
-        _order = self.order.order
-        _bins = self.groupings.bins
-
+        ii, jj, w = self._contig_edges(complete, pseudo_count)
         g = nx.Graph()
-        g.add_nodes_from(_order)
-
-        for i in xrange(len(_order)):
-            if _bins[i] == Grouping.MASK:
-                continue
-            for j in xrange(i+1, len(_order)):
-                if _bins[j] == Grouping.MASK:
-                    continue
-                sm = self.get_submatrix(i, j) + 1
-                n_frg = len(self.groupings.map[i]) * len(self.groupings.map[j])
-                # networkx written to graphml will choke on numpy floats
-                w = float(np.sum(sm)) / n_frg
-                g.add_edge(i, j, weight=w)
+        g.add_nodes_from(self.order.order)
+        # networkx written to graphml will choke on numpy types
+        g.add_weighted_edges_from(zip(ii.tolist(), jj.tolist(), w.tolist()))
         return g
 
+    def order_contigs_by_linkage(self):
+        """
+        Order contigs by the leaves of a single-linkage dendrogram, built from the sparse contig
+        graph without forming a dense distance matrix. Distances are inverse edge weights, with
+        no pseudo-count, so only observed links contribute.
+
+        Single-linkage merges follow the minimum spanning tree of the graph in order of increasing
+        distance, therefore the tree is found on the sparse graph and its edges joined with a
+        union-find. At each merge, the two clusters are oriented so that the contigs joined by the
+        edge become adjacent in the leaf order. Disconnected components are concatenated by
+        decreasing size.
+
+        :return: order of contigs
+        """
+        from scipy.sparse.csgraph import minimum_spanning_tree
+
+        n_seq = len(self.order.names)
+        ii, jj, w = self._contig_edges(pseudo_count=0)
+        mst = minimum_spanning_tree(coo_matrix((1.0 / w, (ii, jj)), shape=(n_seq, n_seq))).tocoo()
+        by_dist = np.argsort(mst.data, kind='mergesort')
+
+        # union-find over contigs, where each root holds the leaf order of its cluster. Cluster
+        # orientation is held as a flag, so that reversing a cluster is free.
+        parent = range(n_seq)
+        leaves = [deque([x]) for x in xrange(n_seq)]
+        flipped = [False] * n_seq
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        def first(c):
+            return leaves[c][-1] if flipped[c] else leaves[c][0]
+
+        def last(c):
+            return leaves[c][0] if flipped[c] else leaves[c][-1]
+
+        for u, v in zip(mst.row[by_dist], mst.col[by_dist]):
+            ru, rv = find(u), find(v)
+            # u should end cluster ru, v should begin cluster rv
+            if last(ru) != u:
+                flipped[ru] = not flipped[ru]
+            if first(rv) != v:
+                flipped[rv] = not flipped[rv]
+
+            # merge the smaller cluster into the larger, placing ru before rv
+            if len(leaves[ru]) >= len(leaves[rv]):
+                big, small, after = ru, rv, True
+            else:
+                big, small, after = rv, ru, False
+            items = list(leaves[small])
+            if flipped[small]:
+                items.reverse()
+            if after != flipped[big]:
+                leaves[big].extend(items if after else reversed(items))
+            else:
+                leaves[big].extendleft(items if after else reversed(items))
+            parent[small] = big
+            leaves[small] = None
+
+        roots = sorted(set(find(x) for x in xrange(n_seq)), key=lambda x: -len(leaves[x]))
+        new_order = []
+        for r in roots:
+            new_order.extend(reversed(leaves[r]) if flipped[r] else leaves[r])
+        return [int(x) for x in new_order]
+
     def order_contigs_by_hc(self):
         from scipy.cluster.hierarchy import complete
         from scipy.spatial.distance import squareform
         from scipy.cluster.hierarchy import dendrogram
-        g = self.create_contig_graph()
+        g = self.create_contig_graph(complete=True)
         inverse_edge_weights(g)
         D = squareform(nx.adjacency_matrix(g).todense())
         Z = complete(D)
@@ -521,7 +947,7 @@ class FragmentMap:
         :param j: second sequence id
         :return: submatrix (nparray) containing raw counts between these sequences
         """
-        _bins = self.groupings.bins
+        _bins = np.clip(self.groupings.bins, 0, None)
         oi = np.sum(_bins[0:i])
         oj = np.sum(_bins[0:j])
         return self.raw_map[oi:oi+_bins[i], oj:oj+_bins[j]]
@@ -533,13 +959,215 @@ class FragmentMap:
     #     Nd = np.sum(self.raw_map)
     #     L =
 
-    def calc_likelihood(self, p0, s0, b):
+    def _init_bin_table(self):
+        """
+        Tabulate, for each bin of the contact map, the sequence to which it belongs and the
+        position of its centre along that sequence. Bins are laid out as in the unordered map.
+        """
+        _bins = self.groupings.bins
+        seq_idx = np.flatnonzero(_bins != Grouping.MASK)
+        self.bin_seq = np.repeat(seq_idx, _bins[seq_idx])
+        self.seq_bins = np.clip(_bins, 0, None)
+        self.seq_bin_offset = self.groupings.offsets
+        self.bin_center = self.groupings.bin_center
+
+    def _inter_contacts(self):
+        """
+        Observed contacts between bins on differing sequences, taken from the sparse form of
+        the raw map. Terms of the likelihood which do not depend on order are also computed.
+
+        :return: dict of rows, cols and counts of inter-sequence contacts, the total number of contacts
+        and the summed log-factorial of counts.
+        """
+        if self._contacts is None:
+            if self.bin_seq is None:
+                self._init_bin_table()
+            m = self.sparse_map if self.sparse_map is not None else coo_matrix(self.raw_map)
+            inter = self.bin_seq[m.row] != self.bin_seq[m.col]
+            counts = m.data[inter].astype(np.float64)
+            rows = m.row[inter]
+            cols = m.col[inter]
+            n_bins = len(self.bin_seq)
+            # symmetric adjacency, for looking up all contacts of a given bin
+            adj = csr_matrix((np.concatenate((counts, counts)),
+                              (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+                             shape=(n_bins, n_bins))
+            self._contacts = {'rows': rows, 'cols': cols, 'counts': counts, 'adj': adj,
+                              'total': float(np.sum(m.data)),
+                              'log_fact': np.sum(gammaln(counts + 1))}
+        return self._contacts
+
+    def bin_positions(self, bins=None):
+        """
+        For the present order and orientation, the position of each bin centre along the
+        concatenated sequences.
+
+        :param bins: indices of the bins of interest, None for all bins
+        :return: array of positions, in the layout of the unordered map.
+        """
+        if self.bin_seq is None:
+            self._init_bin_table()
+        if bins is None:
+            bins = slice(None)
+        _seq = self.bin_seq[bins]
+        _center = self.bin_center[bins]
+        _center = np.where(self.order.reversed[_seq], self.order.lengths[_seq] - _center, _center)
+        return self.order.cum_length[self.order.position[_seq]] + _center
+
+    def _bins_at(self, start, stop):
+        """
+        Indices of the bins belonging to the sequences at order positions [start, stop).
+        """
+        _seqs = self.order.order[start:stop]
+        n = self.seq_bins[_seqs]
+        return np.arange(np.sum(n)) + np.repeat(self.seq_bin_offset[_seqs] - (np.cumsum(n) - n), n)
+
+    def delta_likelihood(self, move):
+        """
+        Calculate the change in logLikelihood which would result from applying a Move, without
+        altering the present order. Only pairs of bins whose separation is changed by the move are
+        visited: pairs between differing segments of the move and pairs between moved bins and those
+        outside the move within the distance at which the contact rate becomes constant.
+
+        :param move: the proposed Move
+        :return: change in logLikelihood
+        """
+        contacts = self._inter_contacts()
+        Nd = contacts['total']
+        _order = self.order
+        far = GRAAL_MAX_SEPARATION
+
+        # layout of the rearranged block, indexed by present order position relative to start
+        width = move.stop - move.start
+        new_start = np.empty(width, dtype=np.int64)
+        new_rev = np.empty(width, dtype=np.bool)
+        seg_label = np.empty(width, dtype=np.int64)
+        offset = _order.cum_length[move.start]
+        for n, (seg_start, seg_stop, flip) in enumerate(move.segments):
+            _seg = np.arange(seg_start, seg_stop)
+            if flip:
+                _seg = _seg[::-1]
+            _seqs = _order.order[_seg]
+            _len = _order.lengths[_seqs]
+            new_start[_seg - move.start] = offset + np.cumsum(_len) - _len
+            new_rev[_seg - move.start] = _order.reversed[_seqs] ^ flip
+            seg_label[_seg - move.start] = n
+            offset += np.sum(_len)
+
+        def new_positions(bins):
+            # positions of bins after the move, bins must belong to the moved block
+            _seq = self.bin_seq[bins]
+            _op = _order.position[_seq] - move.start
+            _center = self.bin_center[bins]
+            return new_start[_op] + np.where(new_rev[_op], _order.lengths[_seq] - _center, _center)
+
+        def sum_rate(d):
+            return np.sum(graal_contact_rate(d))
+
+        moved = self._bins_at(move.start, move.stop)
+        x_old = self.bin_positions(moved)
+        x_new = new_positions(moved)
+        seg = seg_label[_order.position[self.bin_seq[moved]] - move.start]
+
+        # observed contacts involving moved bins
+        sub = contacts['adj'][moved].tocoo()
+        partner = sub.col
+        k = sub.row
+        p_op = _order.position[self.bin_seq[partner]] - move.start
+        p_inside = (p_op >= 0) & (p_op < width)
+        p_old = self.bin_positions(partner)
+        p_new = p_old.copy()
+        p_new[p_inside] = new_positions(partner[p_inside])
+        p_seg = np.where(p_inside, seg_label[np.clip(p_op, 0, width - 1)], -1)
+        # pairs within a segment are unchanged, those between moved segments are visited twice
+        w = np.where(p_seg == seg[k], 0.0, np.where(p_inside, 0.5, 1.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.sum(w * sub.data * (np.log(graal_contact_rate(np.abs(x_new[k] - p_new))) -
+                                           np.log(graal_contact_rate(np.abs(x_old[k] - p_old)))))
+
+        # expected counts between differing segments of the move
+        exp_delta = 0.0
+        for i in xrange(len(move.segments)):
+            mi = seg == i
+            for j in xrange(i+1, len(move.segments)):
+                mj = seg == j
+                exp_delta += sum_rate(np.abs(x_new[mi][:, np.newaxis] - x_new[mj])) - \
+                    sum_rate(np.abs(x_old[mi][:, np.newaxis] - x_old[mj]))
+
+        # expected counts between moved bins and those nearby outside the move
+        block_start = _order.cum_length[move.start]
+        block_stop = _order.cum_length[move.stop]
+        left = np.searchsorted(_order.cum_length, block_start - far, side='right') - 1
+        left = max(left, 0)
+        right = np.searchsorted(_order.cum_length, block_stop + far, side='right')
+        right = min(right, len(_order.order))
+        for (a, b), near in [((left, move.start), np.minimum(x_old, x_new) <= block_start + far),
+                             ((move.stop, right), np.maximum(x_old, x_new) >= block_stop - far)]:
+            if a >= b or not np.any(near):
+                continue
+            x_out = self.bin_positions(self._bins_at(a, b))
+            exp_delta += sum_rate(np.abs(x_new[near][:, np.newaxis] - x_out)) - \
+                sum_rate(np.abs(x_old[near][:, np.newaxis] - x_out))
+
+        return delta - Nd * exp_delta
+
+    def calc_likelihood(self, p0, s0, b, chunk_size=1000):
         """
         Calculate the logLikelihood of a given sequence configuration. The model is adapted from
         GRAAL. Counts are Poisson, with lambda parameter dependent on expected observed contact
         rate as a function of inter-fragment separation. This has been shown experimentally to be
         modelled effectively by a power-law (used here).
 
+        All inter-bin separations for the present order are calculated at once from the bin
+        centres and cumulative sequence lengths. Observed (nonzero) contacts contribute
+        n log(mu) - log(n!), while every inter-sequence pair of bins contributes -mu. Beyond
+        GRAAL_MAX_SEPARATION mu is constant, therefore only nearer pairs are evaluated explicitly,
+        in blocks of rows to bound memory use, and the remainder are counted.
+
+        :param p0: minimum probability of a contact
+        :param s0: characteristic distance at which probability = p0
+        :param b: exponential parameter
+        :param chunk_size: number of bins (rows) handled at once
+        :return:
+        """
+        contacts = self._inter_contacts()
+        Nd = contacts['total']
+        x = self.bin_positions()
+
+        # nonzero entries
+        with np.errstate(divide='ignore'):
+            mu = Nd * graal_contact_rate(np.abs(x[contacts['rows']] - x[contacts['cols']]))
+            sumL = np.sum(contacts['counts'] * np.log(mu)) - contacts['log_fact']
+
+        # expectation over all inter-sequence pairs, whether contacts were observed or not.
+        # With bins sorted by position, the near partners of each bin follow it contiguously.
+        by_pos = np.argsort(x, kind='mergesort')
+        x = x[by_pos]
+        _bin_seq = self.bin_seq[by_pos]
+        n_bins = len(x)
+        near_end = np.searchsorted(x, x + GRAAL_MAX_SEPARATION, side='right')
+        n_inter = (n_bins**2 - np.sum(self.seq_bins**2)) / 2
+        n_near = 0
+        near_sum = 0.0
+        for start in xrange(0, n_bins, chunk_size):
+            stop = min(start + chunk_size, n_bins)
+            last_col = near_end[stop - 1]
+            cols = np.arange(start, last_col)
+            rows = np.arange(start, stop)[:, np.newaxis]
+            near = (cols > rows) & (cols < near_end[start:stop, np.newaxis]) & \
+                   (_bin_seq[start:stop, np.newaxis] != _bin_seq[start:last_col])
+            d = np.abs(x[start:stop, np.newaxis] - x[start:last_col])[near]
+            n_near += len(d)
+            near_sum += np.sum(graal_contact_rate(d))
+        sumL -= Nd * (near_sum + (n_inter - n_near) * GRAAL_MIN_RATE)
+
+        return sumL
+
+    def calc_likelihood_pairwise(self, p0, s0, b):
+        """
+        Reference implementation of calc_likelihood, which visits each pair of sequences in turn.
+        Parameters are as for calc_likelihood.
+
         :param p0: minimum probability of a contact
         :param s0: characteristic distance at which probability = p0
         :param b: exponential parameter
@@ -572,9 +1200,13 @@ class FragmentMap:
                 # intervening contig length.
                 L = self.order.intervening(i, j)
 
-                # bin centers
+                # bin centers, measured from the start of each sequence as presently oriented
                 centers_i = self.groupings.centers[i]
+                if self.order.reversed[i]:
+                    centers_i = self.order.lengths[i] - centers_i
                 centers_j = self.groupings.centers[j]
+                if self.order.reversed[j]:
+                    centers_j = self.order.lengths[j] - centers_j
 
                 # determine relative origin for measuring separation
                 # between sequences. If i comes before j, then distances
@@ -587,7 +1219,7 @@ class FragmentMap:
                     s_j = self.order.lengths[j] - centers_j
 
                 #
-                d_ij = np.abs(L + s_i[:, np.newaxis] - s_j)
+                d_ij = np.abs(L + s_i[:, np.newaxis] + s_j)
 
                 # Here we are using a peice-wise continuous function defined in GRAAL
                 # to relate separation distance to Poisson rate parameter mu.
@@ -615,7 +1247,10 @@ class FragmentMap:
         n = 0
         print_rate = self.total_reads if self.total_reads < 1000 else self.total_reads / 1000
         bin_offset = 0
-        # build a dictionary of all pairs.
+        # fragments (read pairs) are identified by an integer id
+        frag_ids = {}
+        pairs = []
+        # build the table of all reads placed in bins
         for ctg_idx, seq_name in enumerate(self.order.names):
 
             if self.groupings.bins[ctg_idx] <= 0:
@@ -623,6 +1258,9 @@ class FragmentMap:
                 continue
 
             print '\tFetching reads for {0} ...'.format(seq_name)
+            names = []
+            dirs = []
+            positions = []
             for r in self.bam.fetch(seq_name):
                 n += 1
                 if n % print_rate == 0:
@@ -636,133 +1274,104 @@ class FragmentMap:
 
                 # beginning of read is depends in mapping direction
                 refpos = r.reference_start if rdir else r.reference_end
-
-                try:
-                    bin_i = self.groupings.find_nearest(ctg_idx, refpos, rdir)
-                    if rn not in self.pairs:
-                        self.pairs[rn] = {True: [], False: []}
-                    self.pairs[rn][rdir].append(bin_i[1] + bin_offset)
-                except RuntimeError as er:
+                if refpos is None:
                     skipped += 1
-                    #print '\tSkipping read {0} mapped to {1}: {2}'.format(rn, seq_name, er)
+                    continue
+
+                names.append(rn)
+                dirs.append(rdir)
+                positions.append(refpos)
+
+            # assign bins for all reads of this sequence at once
+            bins, valid = self.groupings.find_nearest_bins(ctg_idx, np.array(positions, dtype=np.int64),
+                                                           np.array(dirs, dtype=np.bool))
+            skipped += len(valid) - np.count_nonzero(valid)
+            bins += bin_offset
+
+            ctg_pairs = np.empty(np.count_nonzero(valid), dtype=FragmentMap.PAIR_DTYPE)
+            ctg_pairs['frag'] = [frag_ids.setdefault(names[i], len(frag_ids)) for i in np.flatnonzero(valid)]
+            ctg_pairs['rdir'] = np.array(dirs, dtype=np.bool)[valid]
+            ctg_pairs['bin'] = bins[valid]
+            pairs.append(ctg_pairs)
 
             bin_offset += self.groupings.bins[ctg_idx]
             #print 'ctg_idx {0} bin_offset {1}'.format(ctg_idx, bin_offset)
 
-        print '\nFound {0} fragments in BAM, {1} not reconciled with any site'.format(len(self.pairs), skipped)
-        print '\nFinished building pairs'
+        self.pairs = np.concatenate(pairs) if len(pairs) > 0 else np.empty(0, dtype=FragmentMap.PAIR_DTYPE)
 
-    def _init_map(self, dt=np.int32):
-        n_bins = self.groupings.total_bins()
-        print '\tInitialising contact map of {0}x{0} fragment bins, ' \
-              'representing {1} bp over {2} sequences'.format(n_bins, self.active_len, self.active_seq)
-        return np.zeros((n_bins, n_bins), dtype=dt)
+        print '\nFound {0} fragments in BAM, {1} not reconciled with any site'.format(len(frag_ids), skipped)
+        print '\nFinished building pairs'
 
-    def _determine_block_shifts(self):
+    def _permutation(self):
         """
-        For the present ordering, calculate the block (whole-group) shifts necessary
-        to permute the contact matrix to match the order.
-        :return: list of tuples (start, stop, shift)
+        Integer permutation of bins which reorders the contact map to match the present order
+        and orientation. Element i is the index, in the unordered map, of the bin placed at i.
+        :return: permutation vector
         """
-        # make sure the two arrays are np arrays for fancy indexing tricks
-        _order = np.array(self.order.order)
-        _bins = np.array(self.groupings.bins)
-        _shuf_bins = _bins[_order]
-
-        shifts = []
-        # iterate through current order, determine necessary block shifts
-        curr_bin = 0
-        for shuff_i, org_i in enumerate(_order):
-            if _bins[org_i] == Grouping.MASK:
-                # skip masked bins
-                continue
-            intervening_bins = _bins[:org_i]
-            shft = -(curr_bin - np.sum(intervening_bins))
-            start = np.sum(_bins[:org_i]) if org_i > 0 else 0
-            #stop = start+_bins[org_i]
-            #print '{0} -> {1} {2} {3},{4} s:{5} {6},{7}'.format(org_i, shuff_i, ointervening_bins, start, stop, shft, curr_bin, curr_bin+_bins[org_i])
-            shifts.append((curr_bin, curr_bin+_bins[org_i], shft))
-            curr_bin += _shuf_bins[shuff_i]
-        return shifts
-
-    def _make_permutation_matrix(self):
-        """
-        Create the permutation matrix required to reorder the contact matrix to
-        match the present ordering.
-        :return: permutation matrix
-        """
-        # as a permutation matrix, the identity matrix causes no change
-        P = np.identity(self.groupings.total_bins())
-        block_shifts = self._determine_block_shifts()
-        for si in block_shifts:
-            if si[2] == 0:
-                # ignore blocks which are zero shift.
-                # as we started with identity, these are
-                # already defined.
-                continue
-            # roll along columns, those rows matching each block with
-            # a shift.
-            pi = np.roll(P, si[2], 1)[si[0]:si[1], :]
-            # put the result back into P, overwriting previous identity diagonal
-            P[si[0]:si[1], :] = pi
-        return P
-
-    def reorder_map(self):
+        if self.bin_seq is None:
+            self._init_bin_table()
+        perm = self._bins_at(0, len(self.order.order))
+        # bins of reversed sequences are taken in reverse
+        _seq = self.bin_seq[perm]
+        _first = self.seq_bin_offset[_seq]
+        return np.where(self.order.reversed[_seq], 2*_first + self.seq_bins[_seq] - 1 - perm, perm)
+
+    def reorder_map(self, sparse=False):
         """
-        Reorder the contact matrix to reflect the present order.
+        Reorder the contact matrix to reflect the present order. Rather than permuting the
+        dense map, the row and column indices of each nonzero element are remapped. Elements
+        which end up below the diagonal are reflected back into the upper triangle.
+
+        :param sparse: return a sparse (COO) matrix rather than a dense array
         :return: reordered contact matrix
         """
-        # this may not be necessary, but we construct the full symmetrical map
-        # before reordering, just in case something is reflected over the diagonal
-        # and ends up copying empty space
-        full_map = np.tril(self.raw_map.transpose(), -1) + self.raw_map
-        P = self._make_permutation_matrix()
-        # two applications of P is required to fully reorder the matrix
-        # -- both on rows and columns
-        # finally, convert the result back into a triangular matrix.
-        return np.triu(np.dot(np.dot(P, full_map), P.T))
+        n_bins = self.groupings.total_bins()
+        new_index = np.empty(n_bins, dtype=np.int64)
+        new_index[self._permutation()] = np.arange(n_bins)
+
+        m = self.sparse_map if self.sparse_map is not None else coo_matrix(self.raw_map)
+        rows = new_index[m.row]
+        cols = new_index[m.col]
+        reordered = coo_matrix((m.data, (np.minimum(rows, cols), np.maximum(rows, cols))), shape=(n_bins, n_bins))
+        if sparse:
+            return reordered
+        return reordered.toarray()
 
     def _calculate_map(self):
         """
-        Calculate a raw contact map once .build_pairs() as been called.
-        :return: np array representing the contact map
+        Calculate a raw contact map once ._build_pairs() as been called. Each fragment contributes
+        a contact for every combination of its forward and reverse placements. The map is upper
+        triangular and held both in sparse (COO) and dense form, or only in sparse form when
+        binning individual fragments.
         """
+        n_bins = self.groupings.total_bins()
         print 'Beginning calculation of contact map'
-        self.raw_map = self._init_map()
+        print '\tInitialising contact map of {0}x{0} fragment bins, ' \
+              'representing {1} bp over {2} sequences'.format(n_bins, self.active_len, self.active_seq)
 
-        total_pairs = len(self.pairs)
-        if total_pairs < 1000:
-            rate = total_pairs
-        else:
-            rate = total_pairs / 1000
+        # group forward and reverse placements by fragment
+        _fwd = self.pairs[self.pairs['rdir']]
+        _fwd = _fwd[np.argsort(_fwd['frag'], kind='mergesort')]
+        _rev = self.pairs[~self.pairs['rdir']]
+        _rev = _rev[np.argsort(_rev['frag'], kind='mergesort')]
 
-        n = 0
-        unpaired = 0
-        _map = self.raw_map
-        for v in self.pairs.values():
-            n += 1
-            if n % rate == 0:
-                progress(n, total_pairs, 'Accumulating')
+        # for each forward placement, the range of reverse placements of the same fragment
+        start = np.searchsorted(_rev['frag'], _fwd['frag'], side='left')
+        n = np.searchsorted(_rev['frag'], _fwd['frag'], side='right') - start
+        ir = _fwd['bin'][np.repeat(np.arange(len(_fwd)), n)]
+        ic = _rev['bin'][np.arange(np.sum(n)) + np.repeat(start - (np.cumsum(n) - n), n)]
 
-            if len(v[True]) < 1 or len(v[False]) < 1:
-                unpaired += 1
-                continue
+        unpaired = len(np.unique(self.pairs['frag'])) - len(np.unique(_fwd['frag'][n > 0]))
 
-            try:
-                for ir in v[True]:
-                    for ic in v[False]:
-                        if ic > ir:
-                            _map[ir][ic] += 1
-                        else:
-                            _map[ic][ir] += 1
-            except IndexError as er:
-                print er
-                print ic, ir, v
-                sys.exit(1)
+        self.sparse_map = coo_matrix((np.ones(len(ir), dtype=np.int32), (np.minimum(ir, ic), np.maximum(ir, ic))),
+                                     shape=(n_bins, n_bins))
+        self.sparse_map.sum_duplicates()
+        if not self.per_fragment:
+            self.raw_map = self.sparse_map.toarray()
 
         print '\nIgnored {0} unpaired contacts'.format(unpaired)
         print '\nFinished calculation of contact map'
-        print 'Total raw map weight {0}'.format(np.sum(_map))
+        print 'Total raw map weight {0}'.format(np.sum(self.sparse_map.data))
 
     def calculate_scaled_map(self):
         """
@@ -849,7 +1458,221 @@ class FragmentMap:
 
     @staticmethod
     def write_map(file_name, cmap):
-        np.savetxt(file_name, cmap)
+        if issparse(cmap):
+            # coordinate form, one non-zero element per line
+            cmap = cmap.tocoo()
+            np.savetxt(file_name, np.column_stack((cmap.row, cmap.col, cmap.data)), fmt='%d')
+        else:
+            np.savetxt(file_name, cmap)
+
+
+# annealer shared with worker processes, which inherit it when forked
+_ANNEALER = None
+
+
+def _anneal_worker(args):
+    return _ANNEALER.run(*args)
+
+
+class OrderAnnealer:
+    """
+    Simulated annealing of sequence order and orientation, driven by the FragmentMap likelihood.
+    Proposals are local Moves (swap, shift, block reversal and inversion, orientation flips) scored
+    by their change in logLikelihood. The starting temperature is calibrated from a sample of
+    proposals, then cooled geometrically after each sweep. A chain which stops accepting moves
+    is reheated a limited number of times before it finishes.
+    """
+
+    # relative frequency of each kind of move: swap, shift, reverse, flip block, flip one
+    MOVE_PROB = np.array([0.3, 0.3, 0.1, 0.1, 0.2])
+
+    def __init__(self, frag_map, p0, s0, b, sweeps=100, max_span=10, cooling=0.95, init_accept=0.5,
+                 min_accept=0.001, patience=5, reheats=2, checkpoint=None, checkpoint_rate=10):
+        """
+        :param frag_map: FragmentMap whose order is optimised
+        :param p0: likelihood parameter, see FragmentMap.calc_likelihood
+        :param s0: likelihood parameter, see FragmentMap.calc_likelihood
+        :param b: likelihood parameter, see FragmentMap.calc_likelihood
+        :param sweeps: maximum number of sweeps, each of which is one proposal per sequence
+        :param max_span: largest separation in order positions between the ends of a move
+        :param cooling: geometric cooling factor applied after each sweep
+        :param init_accept: acceptance probability of a typical worsening move at the starting temperature
+        :param min_accept: acceptance rate below which a sweep is considered stalled
+        :param patience: number of consecutive stalled sweeps before reheating or finishing
+        :param reheats: number of times a stalled chain is reheated
+        :param checkpoint: base name of checkpoint files, None to disable checkpointing
+        :param checkpoint_rate: number of sweeps between checkpoints
+        """
+        self.frag_map = frag_map
+        self.model = (p0, s0, b)
+        self.sweeps = sweeps
+        self.max_span = max_span
+        self.cooling = cooling
+        self.init_accept = init_accept
+        self.min_accept = min_accept
+        self.patience = patience
+        self.reheats = reheats
+        self.checkpoint = checkpoint
+        self.checkpoint_rate = checkpoint_rate
+
+    def propose(self, rs):
+        """
+        Draw a random local move.
+        :param rs: numpy RandomState
+        :return: Move
+        """
+        n = len(self.frag_map.order.order)
+        a = rs.randint(n)
+        b = a + rs.randint(1, self.max_span + 1) * (1 if rs.rand() < 0.5 else -1)
+        b = min(max(b, 0), n - 1)
+        kind = np.searchsorted(np.cumsum(OrderAnnealer.MOVE_PROB), rs.rand() * np.sum(OrderAnnealer.MOVE_PROB))
+        if kind == 0 and a != b:
+            return SeqOrder.swap_move(a, b)
+        elif kind == 1:
+            return SeqOrder.shift_move(a, b)
+        elif kind == 2:
+            return SeqOrder.reverse_move(a, b)
+        elif kind == 3:
+            return SeqOrder.flip_move(a, b)
+        return SeqOrder.flip_move(a)
+
+    def calibrate(self, rs, n=200):
+        """
+        Determine a starting temperature at which the average worsening move, among a sample
+        of proposals, is accepted with probability init_accept.
+        :param rs: numpy RandomState
+        :param n: number of proposals to sample
+        :return: temperature
+        """
+        deltas = np.array([self.frag_map.delta_likelihood(self.propose(rs)) for i in xrange(n)])
+        worse = deltas[deltas < 0]
+        if len(worse) == 0:
+            return 1.0
+        return -np.mean(worse) / -np.log(self.init_accept)
+
+    def _checkpoint_file(self, chain_id):
+        return '{0}.chain{1}.npz'.format(self.checkpoint, chain_id)
+
+    def _save_checkpoint(self, chain_id, sweep, temperature, best):
+        np.savez(self._checkpoint_file(chain_id), sweep=sweep, temperature=temperature,
+                 order=self.frag_map.order.order, reversed=self.frag_map.order.reversed,
+                 best_logL=best[0], best_order=best[1], best_reversed=best[2])
+
+    def run(self, chain_id, init_order, init_reversed=None, seed=None, resume=False):
+        """
+        Run a single annealing chain.
+
+        :param chain_id: chain number, used in naming checkpoints
+        :param init_order: starting order
+        :param init_reversed: starting orientations, None for all forward
+        :param seed: random seed
+        :param resume: continue from the chain's checkpoint if one exists
+        :return: tuple of (best logL, best order, best orientation)
+        """
+        fm = self.frag_map
+        rs = np.random.RandomState(seed)
+        n = len(init_order)
+
+        fm.set_order(init_order)
+        if init_reversed is None:
+            fm.order.reversed[:] = False
+        else:
+            fm.order.reversed[:] = init_reversed
+
+        start_sweep = 0
+        temperature = None
+        best = None
+        if resume and self.checkpoint is not None and os.path.exists(self._checkpoint_file(chain_id)):
+            ckpt = np.load(self._checkpoint_file(chain_id))
+            fm.set_order(ckpt['order'])
+            fm.order.reversed[:] = ckpt['reversed']
+            start_sweep = int(ckpt['sweep']) + 1
+            temperature = float(ckpt['temperature'])
+            best = (float(ckpt['best_logL']), ckpt['best_order'], ckpt['best_reversed'])
+            print 'Chain {0} resuming from sweep {1}'.format(chain_id, start_sweep)
+
+        logL = fm.calc_likelihood(*self.model)
+        if best is None:
+            best = (logL, fm.order.order.copy(), fm.order.reversed.copy())
+        if n < 2:
+            return best
+
+        if temperature is None:
+            temperature = self.calibrate(rs)
+        top_temperature = temperature
+
+        stalled = 0
+        reheats = 0
+        sweep = start_sweep - 1
+        for sweep in xrange(start_sweep, self.sweeps):
+            accepted = 0
+            for i in xrange(n):
+                move = self.propose(rs)
+                delta = fm.delta_likelihood(move)
+                if delta >= 0 or rs.rand() < np.exp(delta / temperature):
+                    fm.order.apply_move(move)
+                    logL += delta
+                    accepted += 1
+                    if logL > best[0]:
+                        best = (logL, fm.order.order.copy(), fm.order.reversed.copy())
+
+            rate = float(accepted) / n
+            print 'Chain {0} sweep {1} T={2:.3e} accepted {3:.3f} logL {4:.6e} best {5:.6e}'.format(
+                chain_id, sweep, temperature, rate, logL, best[0])
+
+            if self.checkpoint is not None and (sweep + 1) % self.checkpoint_rate == 0:
+                # also limit drift of the accumulated logL
+                logL = fm.calc_likelihood(*self.model)
+                self._save_checkpoint(chain_id, sweep, temperature, best)
+
+            temperature *= self.cooling
+            stalled = stalled + 1 if rate < self.min_accept else 0
+            if stalled >= self.patience:
+                if reheats >= self.reheats:
+                    break
+                # restart from the best state so far, at a fraction of the initial temperature
+                reheats += 1
+                stalled = 0
+                fm.set_order(best[1])
+                fm.order.reversed[:] = best[2]
+                logL = best[0]
+                temperature = top_temperature * self.cooling ** (reheats * self.patience)
+
+        if self.checkpoint is not None:
+            self._save_checkpoint(chain_id, sweep, temperature, best)
+
+        return best
+
+    def run_chains(self, init_orders, n_chains, processes=1, seed=None, resume=False):
+        """
+        Run several independent chains, returning the best result. Starting orders are assigned
+        to chains in turn.
+
+        :param init_orders: list of starting orders
+        :param n_chains: number of chains
+        :param processes: number of worker processes
+        :param seed: base random seed, each chain is offset from this
+        :param resume: continue chains from their checkpoints
+        :return: list of per-chain results, each a tuple of (best logL, best order, best orientation)
+        """
+        global _ANNEALER
+        _ANNEALER = self
+
+        if seed is None:
+            seed = np.random.randint(1000000)
+        tasks = [(i, init_orders[i % len(init_orders)], None, seed + i, resume) for i in xrange(n_chains)]
+
+        if processes > 1:
+            pool = mp.Pool(processes)
+            try:
+                results = pool.map(_anneal_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_anneal_worker, tasks)
+
+        return results
 
 
 def progress(count, total, suffix=''):
@@ -867,9 +1690,23 @@ def progress(count, total, suffix=''):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Create a HiC fragment map from mapped reads')
-    parser.add_argument('-N', '--max-iter', type=int, default=1, help='Number of brute forace iterations')
+    parser.add_argument('-N', '--max-iter', type=int, default=100, help='Maximum annealing sweeps per chain [100]')
+    parser.add_argument('--chains', type=int, default=2, help='Number of independent annealing chains [2]')
+    parser.add_argument('--processes', type=int, default=1, help='Number of worker processes for chains [1]')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    parser.add_argument('--checkpoint', default=False, action='store_true',
+                        help='Periodically checkpoint annealing chains to OUTPUT_BASE.chainN.npz')
+    parser.add_argument('--resume', default=False, action='store_true', help='Resume chains from checkpoints')
+    parser.add_argument('--sparse-linkage', default=False, action='store_true',
+                        help='Use sparse single-linkage rather than dense complete-linkage HC ordering')
+    parser.add_argument('--quiet', default=False, action='store_true', help='Do not report per-sequence details')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Cache pairs and the contact map in this directory, reusing them on later runs')
     parser.add_argument('--min-sites', type=int, default=1, help='Ignore bins with less than minimum sites [1]')
-    parser.add_argument('--enzyme', help='Enzyme used in HiC restriction digest')
+    parser.add_argument('--enzyme', nargs='+', help='Enzyme used in HiC restriction digest, '
+                                                    'multiple enzymes for a cocktail')
+    parser.add_argument('--per-fragment', default=False, action='store_true',
+                        help='Bin individual restriction fragments, using only a sparse map. Plots are not produced')
     parser.add_argument('--simu-reads', default=False, action='store_true', help='Handle simulator reads')
     parser.add_argument('--bin-width', type=int, default=10, help='Bin size in bp (25000)')
     parser.add_argument('--remove-diag', default=False, action='store_true',
@@ -880,12 +1717,21 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     fm = FragmentMap(args.bamfile, args.refseq, args.enzyme, min_sites=args.min_sites,
-                     bin_width=args.bin_width, simu_reads=args.simu_reads)
+                     bin_width=args.bin_width, simu_reads=args.simu_reads, cache_dir=args.cache_dir,
+                     quiet=args.quiet, per_fragment=args.per_fragment)
+
+    def plot_order(file_name):
+        # images of fragment resolution maps would be impractically large
+        if not args.per_fragment:
+            fm.plot_map(file_name, fm.reorder_map(), fm.groupings.total_bins(), remove_diag=args.remove_diag)
 
     print 'Writing raw output'
-    fm.write_map('{0}.raw.cm'.format(args.output[0]), fm.raw_map)
-    fm.plot_map('{0}.raw.png'.format(args.output[0]),
-                fm.raw_map, fm.groupings.total_bins(), remove_diag=args.remove_diag)
+    if args.per_fragment:
+        fm.write_map('{0}.raw.cm'.format(args.output[0]), fm.sparse_map)
+    else:
+        fm.write_map('{0}.raw.cm'.format(args.output[0]), fm.raw_map)
+        fm.plot_map('{0}.raw.png'.format(args.output[0]),
+                    fm.raw_map, fm.groupings.total_bins(), remove_diag=args.remove_diag)
 
     with open(args.output[0] + '.log', 'w') as log_h:
 
@@ -894,51 +1740,46 @@ if __name__ == '__main__':
         init_order = fm.order_contigs()
         print 'Adhoc reordering     ', init_order
         fm.set_order(init_order)
-        new_map = fm.reorder_map()
-        fm.plot_map('{0}.reorg.png'.format(args.output[0]),
-                    new_map, fm.groupings.total_bins(), remove_diag=args.remove_diag)
+        plot_order('{0}.reorg.png'.format(args.output[0]))
         logL = fm.calc_likelihood(2.3e-6, 430000.0, 0.11)
-        print 'Ad-hoc ordering logL {0}'.format(fm.calc_likelihood(2.3e-6, 430000.0, 0.11))
+        print 'Ad-hoc ordering logL {0}'.format(logL)
 
-        hc_order = fm.order_contigs_by_hc()
-        print 'HC complete reordering', hc_order
+        if args.sparse_linkage:
+            hc_order = fm.order_contigs_by_linkage()
+            print 'HC single reordering  ', hc_order
+        else:
+            hc_order = fm.order_contigs_by_hc()
+            print 'HC complete reordering', hc_order
         fm.set_order(hc_order)
-        new_map = fm.reorder_map()
-        fm.plot_map('{0}.hc.png'.format(args.output[0]),
-                    new_map, fm.groupings.total_bins(), remove_diag=args.remove_diag)
+        plot_order('{0}.hc.png'.format(args.output[0]))
         print 'HC ordering logL     {0}'.format(fm.calc_likelihood(2.3e-6, 430000.0, 0.11))
 
-        sys.exit(0)
-        max_n = args.max_iter
-        max_lL = None
-        max_order = None
-        max_names = None
-        for n in xrange(max_n):
-            if n % 50 == 0:
-                print 'Finished {0}/{1} calcs'.format(n, max_n)
-
-            logL = fm.calc_likelihood(2.3e-6, 430000.0, 0.11)
-            if logL > max_lL or not max_lL:
-                max_lL = logL
-                max_order = fm.order.order.copy()
-                print max_lL
-                print max_order
-                max_names = np.array(fm.order.names)[fm.order.order].tolist()
-
-            order_str = ' '.join([str(oi) for oi in fm.order.order])
-            log_h.write('{0} {1}\n'.format(n, max_names))
-            log_h.write('{0} {1} {2}\n'.format(n, order_str, logL))
-            fm.shuffle_order()
-
-        order_str = ' '.join([str(oi) for oi in max_order])
+        print 'Annealing order with {0} chains ...'.format(args.chains)
+        annealer = OrderAnnealer(fm, 2.3e-6, 430000.0, 0.11, sweeps=args.max_iter,
+                                 checkpoint=args.output[0] if args.checkpoint else None)
+        results = annealer.run_chains([init_order, hc_order], args.chains, processes=args.processes,
+                                      seed=args.seed, resume=args.resume)
+        for n, (chain_lL, chain_order, chain_rev) in enumerate(results):
+            order_str = ' '.join(['{0}{1}'.format(oi, '-' if chain_rev[oi] else '+') for oi in chain_order])
+            log_h.write('{0} {1} {2}\n'.format(n, order_str, chain_lL))
+
+        max_lL, max_order, max_rev = max(results, key=lambda x: x[0])
+        order_str = ' '.join(['{0}{1}'.format(oi, '-' if max_rev[oi] else '+') for oi in max_order])
         print 'Maximum logL was {0} for order {1}'.format(max_lL, order_str)
 
         with open('{0}.reord.fasta'.format(args.output[0]), 'w') as out_h:
-            seqs = [seq for seq in SeqIO.parse(args.refseq, 'fasta')]
+            seqs = SeqIO.to_dict(SeqIO.parse(args.refseq, 'fasta'))
             for oi in max_order:
-                SeqIO.write(seqs[oi], out_h, 'fasta')
+                seq = seqs[fm.order.names[oi]]
+                if max_rev[oi]:
+                    seq = seq.reverse_complement(id=True, name=True, description=True)
+                SeqIO.write(seq, out_h, 'fasta')
+            # sequences excluded from the map follow in their original order
+            ordered = set(fm.order.names)
+            for seq in SeqIO.parse(args.refseq, 'fasta'):
+                if seq.id not in ordered:
+                    SeqIO.write(seq, out_h, 'fasta')
 
         fm.set_order(max_order)
-        new_map = fm.reorder_map()
-        fm.plot_map('{0}.maxLL.png'.format(args.output[0]),
-                    new_map, fm.groupings.total_bins(), remove_diag=args.remove_diag)
+        fm.order.reversed[:] = max_rev
+        plot_order('{0}.maxLL.png'.format(args.output[0]))
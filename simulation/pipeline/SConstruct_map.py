@@ -127,20 +127,45 @@ def make_hic2ctg(outdir, c):
     return 'output', env.Command(target, source, action)
 
 
-wrap.add('hic_min_cov', [0, 0.5, 0.95])
-wrap.add('hic_min_qual', [0, 30, 60])
+hic_min_cov = [0, 0.5, 0.95]
+hic_min_qual = [0, 30, 60]
 
 
-@wrap.add_target('filter_hic2ctg')
-@name_targets
-def filter_hic(outdir, c):
+def grid_key(cov, qual):
+    return '{0}_{1}'.format(cov, qual)
+
+
+# Every combination of filter thresholds is written in a single pass over the HiC mapping.
+# Each output is written to the directory which the hic_min_cov and hic_min_qual levels
+# below create for its combination, under the same name as an unfiltered mapping, where
+# the clustering stages look for it. The filter level then refers to that output.
+@wrap.add_target('filter_hic2ctg_grid')
+def filter_hic_grid(outdir, c):
     source = str(c['make_hic2ctg']['output'])
-    target = os.path.join(outdir, config['hic2ctg'])
+    grid = [(cov, qual) for cov in hic_min_cov for qual in hic_min_qual]
+    target = [os.path.join(outdir, str(cov), str(qual), config['hic2ctg']) for cov, qual in grid]
+
+    # first combination is passed as the primary output, the remainder as triplets
+    args = '{0[0]} {0[1]} $SOURCE ${{TARGETS[0]}}'.format(grid[0])
+    for i in xrange(1, len(grid)):
+        args += ' {0[0]} {0[1]} ${{TARGETS[{1}]}}'.format(grid[i], i)
+
     action = exec_env.resolve_action({
-        'pbs': 'bin/pbsrun_BAMFILTER.sh {0[hic_min_cov]} {0[hic_min_qual]} $SOURCE $TARGET'.format(c),
-        'sge': 'bin/sgerun_BAMFILTER.sh {0[hic_min_cov]} {0[hic_min_qual]} $SOURCE $TARGET'.format(c)
+        'pbs': 'bin/pbsrun_BAMFILTER.sh ' + args,
+        'sge': 'bin/sgerun_BAMFILTER.sh ' + args
     })
-    return 'output', env.Command(target, source, action)
+    # keyed by strings, as the controls are written out as JSON
+    return dict(zip([grid_key(cov, qual) for cov, qual in grid], env.Command(target, source, action)))
+
+
+wrap.add('hic_min_cov', hic_min_cov)
+wrap.add('hic_min_qual', hic_min_qual)
+
+
+@wrap.add_target('filter_hic2ctg')
+@name_targets
+def filter_hic(outdir, c):
+    return 'output', [c['filter_hic2ctg_grid'][grid_key(c['hic_min_cov'], c['hic_min_qual'])]]
 
 
 """ MOVING ALL OF THESE TO SEPARATE MAKE FILE
@@ -3,16 +3,12 @@ from Bio import SeqIO
 from collections import OrderedDict
 
 import Psl
+import cigar_stats
 import truthtable as tt
 
 import numpy as np
 import argparse
 import sys
-import re
-
-
-# CIGAR matcher for aligning regions
-matcher = re.compile(r'([0-9]+)M')
 
 
 def count_aligned(cigar):
@@ -21,7 +17,7 @@ def count_aligned(cigar):
     :param cigar: SAMtools CIGAR string
     :return: total number of aligned bases
     """
-    return sum([int(seg_len) for seg_len in matcher.findall(cigar)])
+    return cigar_stats.string_stats(cigar).match
 
 
 class Alignment:
@@ -4,14 +4,20 @@ Convert a SAM file to edge CSV file suitable for importing into Gephi
 
 """
 
+from collections import OrderedDict
 import argparse
 import math
+import multiprocessing as mp
 import re
 import sys
 
-import networkx as nx
+import numpy as np
+import pandas as pd
 import pysam
 
+import cigar_stats
+import graph_tables
+
 
 class Edge:
     """Represents an edge in the network of contigs linked
@@ -82,14 +88,6 @@ class Node:
             id=self.id, length=self.length, reads=self.reads)
 
 
-CODE2CIGAR = dict((y, x) for x, y in enumerate("MIDNSHP=X"))
-CIGAR_REGEX = re.compile(r"(\d+)([MIDNSHP=X])")
-
-
-def cigar_to_tuple(cigar):
-    return [(CODE2CIGAR[t[1]], int(t[0])) for t in CIGAR_REGEX.findall(cigar)]
-
-
 def update_linkage_map(l):
     """Parse the line for new information about contig linkages. These
     may be self-self linkages or between inter-contig.
@@ -130,23 +128,25 @@ def split_name(query_name):
 # cigar tuple values not allowed in matches
 # 2=D, 3=N, 6=P, 8=X
 NOT_ALLOWED = {2, 3, 6, 8}
+NOT_ALLOWED_MASK = cigar_stats.op_mask(NOT_ALLOWED)
 
 
-def good_match(cigartuples, min_match=None, match_start=True):
+def good_match(st, min_match=None, match_start=True):
+    """
+    :param st: CigarStats of the alignment
+    """
 
     # restrict tuples to a subset of possible conditions
-    if len(NOT_ALLOWED & set([t[0] for t in cigartuples])) != 0:
+    if st.op_mask & NOT_ALLOWED_MASK:
         return False
 
     # match the first N bases if requested
-    elif match_start and cigartuples[0][0] != 0:
+    elif match_start and st.first_op != cigar_stats.MATCH:
         return False
 
     # impose minimum number of matches
-    elif min_match:
-        n_matches = sum([t[1] for t in cigartuples if t[0] == 0])
-        if n_matches < min_match:
-            return False
+    elif min_match and st.match < min_match:
+        return False
 
     return True
 
@@ -162,7 +162,720 @@ def strong_match(mr, min_match=None, match_start=True, min_mapq=None):
     if min_mapq and mr.mapping_quality < min_mapq:
         return False
 
-    return good_match(mr.cigartuples, min_match, match_start)
+    st = cigar_stats.read_stats(mr)
+    return st is not None and good_match(st, min_match, match_start)
+
+
+# alternate alignments in an XA field, each as "contig,pos,CIGAR,NM;"
+XA_REGEX = re.compile(r"([^,;]+),([-+]?\d+),([^,;]+),(\d+)(?:;|$)")
+
+
+def alt_hits(alts_field):
+    """Split the XA field of alternate alignments into its hits.
+
+    :param alts_field: XA tag value
+    :return: list of (contig, cigar, edit distance)
+    """
+    hits = XA_REGEX.findall(alts_field)
+
+    # every semi-colon delimited hit must have been parsed
+    n_fields = alts_field.count(';') + (0 if alts_field.endswith(';') else 1)
+    if len(hits) != n_fields:
+        raise IOError('alternate alignment did not contain four fields. [{0}]'.format(alts_field))
+
+    return [(ctg, cig, int(nm)) for ctg, pos, cig, nm in hits]
+
+
+def parse_alts(alts_field, min_match=None):
+    """Parse the XA field of alternate alignments. Hits are accepted when they have no edits and
+    their CIGAR is a good match. The statistics of each distinct CIGAR are remembered by cigar_stats.
+
+    :param alts_field: XA tag value
+    :param min_match: minimum number of matches for a good match
+    :return: list of (contig, accepted)
+    """
+    alts = []
+    for ctg, cig, nm in alt_hits(alts_field):
+        if nm > 0:
+            alts.append((ctg, False))
+            continue
+        alts.append((ctg, good_match(cigar_stats.string_stats(cig), min_match, True)))
+    return alts
+
+
+class ContigRegistry:
+    """Integer identifiers for contigs, assigned in order of registration, along
+    with their lengths.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.lengths = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return self.index[name]
+
+    def add(self, name, length):
+        """
+        Register a contig, returning its id. Contigs already registered retain their id.
+        """
+        cid = self.index.get(name)
+        if cid is None:
+            cid = len(self.names)
+            self.index[name] = cid
+            self.names.append(name)
+            self.lengths.append(length)
+        return cid
+
+
+class EdgeCounter:
+    """Accumulate undirected edge weights between integer contig ids.
+
+    Linkages are buffered as packed int64 keys and periodically reduced to the distinct
+    keys and their counts. Memory is then bounded by the number of distinct edges rather
+    than the number of linkages.
+    """
+
+    def __init__(self, buffer_size=1000000):
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.total = 0
+
+    def add(self, u, v):
+        if u > v:
+            u, v = v, u
+        self.buffer.append((u << 32) | v)
+        self.total += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def _reduce(self, keys, counts):
+        self.keys, inv = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.counts = np.bincount(inv, weights=np.concatenate((self.counts, counts)),
+                                  minlength=len(self.keys)).astype(np.int64)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self._reduce(np.array(self.buffer, dtype=np.int64), np.ones(len(self.buffer), dtype=np.int64))
+            self.buffer = []
+
+    def merge(self, other):
+        """
+        Add the counts of another counter to this one.
+        """
+        other.flush()
+        self.flush()
+        self._reduce(other.keys, other.counts)
+        self.total += other.total
+
+    def add_pairs(self, u, v):
+        """
+        Add many linkages at once, given as arrays of contig ids.
+        """
+        u, v = np.minimum(u, v).astype(np.int64), np.maximum(u, v).astype(np.int64)
+        self.flush()
+        self._reduce((u << 32) | v, np.ones(len(u), dtype=np.int64))
+        self.total += len(u)
+
+    def edges(self):
+        """
+        :return: arrays (u, v, weight) of all edges, ordered by u then v.
+        """
+        self.flush()
+        return self.keys >> 32, self.keys & 0xffffffff, self.counts
+
+
+def count_linkages(linkages, counter):
+    """Count the linkages of a single insert. Linkages are (contig_id, direction) pairs and only
+    those between opposing directions of the ligation product form edges.
+    """
+    n_links = len(linkages)
+    for i in xrange(n_links):
+        u, udir = linkages[i]
+        for j in xrange(i+1, n_links):
+            v, vdir = linkages[j]
+            if udir != vdir:
+                counter.add(u, v)
+
+
+def count_linkage_table(reads, dirs, ctgs, counter):
+    """Vectorised form of count_linkages, over a table of the linkages of many inserts.
+
+    :param reads: integer insert id of each linkage
+    :param dirs: integer direction of each linkage
+    :param ctgs: contig id of each linkage
+    :param counter: edge counter
+    """
+    order = np.argsort(reads, kind='mergesort')
+    reads, dirs, ctgs = reads[order], dirs[order], ctgs[order]
+
+    # every later linkage of the same insert is a partner
+    n = len(reads)
+    n_partners = np.searchsorted(reads, reads, side='right') - np.arange(n) - 1
+    i = np.repeat(np.arange(n), n_partners)
+    j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(n_partners) - n_partners, n_partners)
+
+    opposed = dirs[i] != dirs[j]
+    counter.add_pairs(ctgs[i[opposed]], ctgs[j[opposed]])
+
+
+# line marks a non-header line
+PSL_DATALINE = re.compile(r'^[0-9]+\t')
+
+# PSL fields required in building linkages
+PSL_COLUMNS = {0: 'matches', 1: 'mismatches', 2: 'repmatches', 4: 'q_num_insert', 9: 'q_name',
+               10: 'q_size', 11: 'q_start', 12: 'q_end', 13: 't_name', 14: 't_size'}
+
+
+def psl_linkages(psl_file, contigs, counter, args, chunk_size=1000000):
+    """Count the linkages of a PSL file of HiC reads aligned to contigs. The file is parsed in
+    chunks of columns, upon which the coverage and percentage identity constraints are applied
+    in vectorised form. Read names are assumed to follow our HiC naming convention.
+
+    :param psl_file: PSL file
+    :param contigs: contig registry
+    :param counter: edge counter
+    :param args: command line arguments
+    :param chunk_size: number of records per chunk
+    :return: dict of accept/reject counts
+    """
+    # skip header fields
+    n_header = 0
+    with open(psl_file, 'r') as h_in:
+        for line in h_in:
+            if PSL_DATALINE.match(line):
+                break
+            n_header += 1
+
+    stats = new_stats()
+    reads = []
+    dirs = []
+    ctgs = []
+    chunks = pd.read_csv(psl_file, sep='\t', header=None, skiprows=n_header, usecols=sorted(PSL_COLUMNS),
+                         chunksize=chunk_size)
+    for chunk in chunks:
+        chunk = chunk.rename(columns=PSL_COLUMNS)
+
+        for name, size in chunk[['t_name', 't_size']].drop_duplicates('t_name').itertuples(index=False):
+            contigs.add(name, size)
+
+        alen = chunk.q_end - chunk.q_start + 1
+
+        # Taken from BLAT perl script for calculating percentage identity
+        perid = (1.0 - (chunk.mismatches + chunk.q_num_insert).astype(float) /
+                 (chunk.matches + chunk.mismatches + chunk.repmatches)) * 100.0
+
+        # ignore alignment records which fall below mincov or minid
+        # wrt the length of the alignment vs query sequence.
+        keep = (alen.astype(float) / chunk.q_size >= args.mincov) & (perid >= args.minid)
+        stats['reject'] += len(chunk) - keep.sum()
+        stats['accept'] += keep.sum()
+        chunk = chunk[keep]
+
+        # assumed naming convention of HiC simulated reads.
+        reads.append(chunk.q_name.str[:-3].values)
+        dirs.append(chunk.q_name.str[-3:].values)
+        ctgs.append(chunk.t_name.map(contigs.index).values)
+
+    if len(reads) > 0:
+        print 'Creating graph from linkage map'
+        count_linkage_table(pd.factorize(np.concatenate(reads))[0], pd.factorize(np.concatenate(dirs))[0],
+                            np.concatenate(ctgs).astype(np.int64), counter)
+
+    return stats
+
+
+def read_direction(mr, file_dir, sim=False, merged=False):
+    """Determine the insert and direction to which a mapped read belongs.
+
+    :param mr: the mapped read
+    :param file_dir: direction implied by the input file in split mode
+    :param sim: simulated read names, which carry their direction as a suffix
+    :param merged: reads from both directions are in a single file, distinguished by read1/read2 flags
+    :return: (read, direction)
+    """
+    if sim:
+        suffix = mr.query_name[-3:]
+        if suffix == 'fwd':
+            return mr.query_name[:-3], 0
+        elif suffix == 'rev':
+            return mr.query_name[:-3], 1
+        raise IOError('simulated read names must end in "fwd" or "rev"')
+    elif merged:
+        return mr.query_name, 1 if mr.is_read1 else 2
+    return mr.query_name, file_dir
+
+
+def record_contigs(mr, tid_map, contigs, args, stats):
+    """Apply the alignment constraints to a mapped read, returning the set of contig ids to which it
+    links or None if the read is rejected. Statistics are updated in place.
+
+    :param mr: the mapped read
+    :param tid_map: contig id of each reference in the BAM header
+    :param contigs: contig registry, for alternate alignments
+    :param args: command line arguments
+    :param stats: dict of accept/reject counts
+    :return: set of contig ids or None
+    """
+    if mr.reference_id == -1:
+        stats['reject'] += 1
+        return None
+
+    # apply the constraints on alignment coverage and percent identity
+    if args.strong and not strong_match(mr, args.strong, True, args.mapq):
+        stats['reject'] += 1
+        return None
+
+    stats['accept'] += 1
+
+    # contig that this alignment line refers to directly
+    contig_set = {tid_map[mr.reference_id]}
+
+    # if requested, add also alternate alignment contigs for linkage map
+    if args.recover_alts:
+        try:
+            # XA field contains alternate alignments for read, semi-colon delimited
+            alts_field = mr.get_tag('XA')
+        except KeyError:
+            alts_field = None
+
+        if alts_field:
+            for ctg, accepted in parse_alts(alts_field, args.strong):
+                if accepted:
+                    contig_set.add(contigs[ctg])
+                    stats['alt_ok'] += 1
+                else:
+                    stats['alt_rej'] += 1
+
+    return contig_set
+
+
+def register_references(bf, contigs):
+    """Register the references of a BAM file.
+
+    :return: list of contig ids, indexed by reference id
+    """
+    return [contigs.add(rn, ln) for rn, ln in zip(bf.references, bf.lengths)]
+
+
+def iter_read_groups(bf, file_dir, contigs, args, stats):
+    """Iterate over a BAM file grouped by read name, such as one collated or sorted by queryname.
+    Consecutive records of the same insert are yielded together as soon as the group ends.
+
+    Unplaced reads are skipped without being counted, as they are never visited by the
+    reference-ordered scans of the other modes.
+
+    :return: generator of (read, linkages), where linkages is a list of (contig_id, direction)
+    """
+    merged = args.split is None
+    tid_map = register_references(bf, contigs)
+    group_read = None
+    linkages = []
+    for mr in bf.fetch(until_eof=True):
+        if mr.reference_id == -1:
+            continue
+        contig_set = record_contigs(mr, tid_map, contigs, args, stats)
+        if contig_set is None:
+            continue
+        read, rdir = read_direction(mr, file_dir, args.sim, merged)
+        if read != group_read:
+            if group_read is not None:
+                yield group_read, linkages
+            group_read = read
+            linkages = []
+        linkages.extend((ctg, rdir) for ctg in contig_set)
+    if group_read is not None:
+        yield group_read, linkages
+
+
+def join_read_groups(groups_r1, groups_r2):
+    """Join the read groups of two files which share the same read order, such as R1 and R2 files
+    sorted by queryname with the same tool. Files which do not share an order, such as collated
+    files, would be mis-joined, so callers must ensure both are queryname sorted. Either file may lack some reads. Groups are held only
+    until their partner is found, or it is clear they have none, so memory is bounded by how far
+    the two files drift apart.
+
+    :return: generator of (read, linkages) from both files
+    """
+    streams = [iter(groups_r1), iter(groups_r2)]
+    pending = [OrderedDict(), OrderedDict()]
+    active = [True, True]
+    while active[0] or active[1]:
+        for k in xrange(2):
+            if not active[k]:
+                continue
+            try:
+                read, linkages = next(streams[k])
+            except StopIteration:
+                active[k] = False
+                continue
+
+            other = pending[1-k]
+            if read not in other:
+                pending[k][read] = linkages
+                continue
+
+            # reads pending in either stream ahead of this one can no longer be matched
+            for r, l in pending[k].iteritems():
+                yield r, l
+            pending[k].clear()
+            while True:
+                r, l = other.popitem(last=False)
+                if r == read:
+                    yield read, l + linkages
+                    break
+                yield r, l
+
+    for k in xrange(2):
+        for r, l in pending[k].iteritems():
+            yield r, l
+
+
+def add_linkages(records, file_dir, tid_map, contigs, args, stats, linkage_map, start=None):
+    """Add the linkages of a set of mapped reads to a linkage map, keyed by read.
+
+    :param records: iterable of mapped reads
+    :param file_dir: direction implied by the input file in split mode
+    :param tid_map: contig id of each reference in the BAM header
+    :param contigs: contig registry
+    :param args: command line arguments
+    :param stats: dict of accept/reject counts
+    :param linkage_map: dict of read to list of (contig_id, direction)
+    :param start: if given, only reads which begin at or after start are considered
+    """
+    merged = args.split is None
+    for mr in records:
+
+        # reads overlapping the beginning of a region belong to the preceding region
+        if start is not None and mr.reference_start < start:
+            continue
+
+        contig_set = record_contigs(mr, tid_map, contigs, args, stats)
+        if contig_set is None:
+            continue
+
+        read, rdir = read_direction(mr, file_dir, args.sim, merged)
+        ctg_assocs = [(ctg, rdir) for ctg in contig_set]
+
+        linkage = linkage_map.get(read)
+        if linkage is None:
+            linkage_map[read] = ctg_assocs
+        else:
+            linkage.extend(ctg_assocs)
+
+
+def new_stats():
+    return {'reject': 0, 'accept': 0, 'alt_rej': 0, 'alt_ok': 0}
+
+
+def add_stats(stats, other):
+    for k in stats:
+        stats[k] += other[k]
+
+
+def region_tasks(bf, file_idx, span):
+    """Divide the references of an indexed BAM file into tasks of approximately span bp. Long
+    references are split into ranges, while short references are batched together.
+
+    :return: list of (file_idx, [(tid, start, end), ...])
+    """
+    tasks = []
+    regions = []
+    task_len = 0
+    for tid, ln in enumerate(bf.lengths):
+        for start in xrange(0, ln, span):
+            end = min(start + span, ln)
+            regions.append((tid, start, end))
+            task_len += end - start
+            if task_len >= span:
+                tasks.append((file_idx, regions))
+                regions = []
+                task_len = 0
+    if len(regions) > 0:
+        tasks.append((file_idx, regions))
+    return tasks
+
+
+# state shared with worker processes, which inherit it when forked
+_SCAN = None
+
+
+def _scan_regions(task):
+    """Worker scanning the regions of a single task.
+
+    :return: (file_idx, stats, linkage_map)
+    """
+    file_idx, regions = task
+    fn, file_dir, tid_map = _SCAN['files'][file_idx]
+    stats = new_stats()
+    linkage_map = {}
+    with pysam.AlignmentFile(fn, 'rb') as bf:
+        for tid, start, end in regions:
+            add_linkages(bf.fetch(bf.references[tid], start, end), file_dir, tid_map, _SCAN['contigs'],
+                         _SCAN['args'], stats, linkage_map, start=start)
+    return file_idx, stats, linkage_map
+
+
+def _count_range(bounds):
+    """Worker counting the edges of a range of inserts.
+
+    :return: partial edge counter
+    """
+    counter = EdgeCounter()
+    for linkages in _SCAN['linkages'][bounds[0]:bounds[1]]:
+        count_linkages(linkages, counter)
+    counter.flush()
+    return counter
+
+
+def parallel_edges(bam_files, contigs, counter, args, stats):
+    """Build edges from indexed BAM files, dividing the references into region tasks across worker
+    processes. As the reads of an insert can fall in different regions, workers return partial linkage
+    maps which are joined by read. The joined inserts are then divided amongst workers again, whose
+    partial edge counts are merged into counter.
+
+    Unplaced reads are not visited by region queries, nor by a serial scan, so are not counted.
+
+    :return: list of per-file stats
+    """
+    global _SCAN
+
+    files = []
+    tasks = []
+    file_stats = []
+    for file_dir, fn in enumerate(bam_files, start=1):
+        with pysam.AlignmentFile(fn, 'rb') as bf:
+            if not bf.has_index():
+                print 'Error: {0} is not indexed, parallel scanning requires an index'.format(fn)
+                sys.exit(1)
+            files.append((fn, file_dir, register_references(bf, contigs)))
+            span = max(1, sum(bf.lengths) // (args.processes * 8))
+            tasks.extend(region_tasks(bf, len(files) - 1, span))
+            file_stats.append(new_stats())
+
+    _SCAN = {'files': files, 'contigs': contigs, 'args': args}
+
+    print 'Scanning {0} regions with {1} processes...'.format(len(tasks), args.processes)
+    linkage_map = {}
+    pool = mp.Pool(args.processes)
+    try:
+        for file_idx, task_stats, partial in pool.imap_unordered(_scan_regions, tasks):
+            add_stats(file_stats[file_idx], task_stats)
+            for read, linkages in partial.iteritems():
+                linkage = linkage_map.get(read)
+                if linkage is None:
+                    linkage_map[read] = linkages
+                else:
+                    linkage.extend(linkages)
+    finally:
+        pool.close()
+        pool.join()
+
+    print 'Creating graph from linkage map'
+    _SCAN['linkages'] = linkage_map.values()
+    del linkage_map
+    n_inserts = len(_SCAN['linkages'])
+    step = max(1, n_inserts // (args.processes * 4))
+    pool = mp.Pool(args.processes)
+    try:
+        for partial in pool.imap_unordered(_count_range, [(i, i + step) for i in xrange(0, n_inserts, step)]):
+            counter.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+    _SCAN = None
+
+    for fs in file_stats:
+        add_stats(stats, fs)
+    return file_stats
+
+
+# columns of the contact table, one row per contig to which an alignment record links
+CONTACT_COLUMNS = [
+    ('insert', np.int64),     # insert id, shared by both reads of a pair
+    ('record', np.int64),     # alignment record id
+    ('direction', np.int8),   # read direction
+    ('contig', np.int32),     # contig id
+    ('mapq', np.int16),       # mapping quality of the record
+    ('match', np.int32),      # matching bases of the record, -1 if it has no CIGAR
+    ('good', np.bool_),       # record is primary and a good match, regardless of match length
+    ('alt', np.bool_),        # row is an alternate alignment of the record, taken from its XA field
+    ('alt_match', np.int32),  # matching bases of the alternate alignment, -1 for the record itself
+    ('alt_good', np.bool_)    # alternate alignment has no edits and is a good match
+]
+
+
+def scan_contacts(bam_files, contigs, args):
+    """Build a contact table from BAM files, independent of the alignment constraints. Every placed
+    record is kept, along with the statistics on which the constraints are decided, so that edges for
+    any constraints can be produced by contact_edges without rescanning the BAM files. Alternate
+    alignments are only parsed and kept when recovering alts.
+
+    :param bam_files: BAM files, in direction order when split
+    :param contigs: contig registry
+    :param args: command line arguments
+    :return: contact table as a dict of column arrays, with the contig names and lengths
+    """
+    merged = args.split is None
+    inserts = {}
+    rows = []
+    n_records = 0
+    for file_dir, fn in enumerate(bam_files, start=1):
+        print 'Parsing {0}...'.format(fn)
+        with pysam.AlignmentFile(fn, 'rb', threads=args.threads) as bf:
+            tid_map = register_references(bf, contigs)
+            for mr in bf.fetch(until_eof=True):
+                # unplaced reads are not visited by the serial scan, so are not counted
+                if mr.reference_id == -1:
+                    continue
+
+                read, rdir = read_direction(mr, file_dir, args.sim, merged)
+                insert = inserts.setdefault(read, len(inserts))
+
+                st = cigar_stats.read_stats(mr)
+                if st is None:
+                    match, good = -1, False
+                else:
+                    match = st.match
+                    good = not (mr.is_secondary or mr.is_supplementary) and good_match(st)
+
+                record = (insert, n_records, rdir)
+                rows.append(record + (tid_map[mr.reference_id], mr.mapping_quality, match, good, False, -1, False))
+
+                if args.recover_alts:
+                    try:
+                        alts_field = mr.get_tag('XA')
+                    except KeyError:
+                        alts_field = None
+                else:
+                    alts_field = None
+                if alts_field:
+                    for ctg, cig, nm in alt_hits(alts_field):
+                        alt_st = cigar_stats.string_stats(cig)
+                        rows.append(record + (contigs[ctg], mr.mapping_quality, match, good, True,
+                                              alt_st.match, nm == 0 and good_match(alt_st)))
+                n_records += 1
+
+    table = np.array(rows, dtype=CONTACT_COLUMNS)
+    contacts = dict((n, table[n]) for n, dt in CONTACT_COLUMNS)
+    contacts['contig_name'] = np.array(contigs.names)
+    contacts['contig_length'] = np.array(contigs.lengths, dtype=np.int64)
+    contacts['alts'] = args.recover_alts
+    return contacts
+
+
+def write_contacts(file_name, contacts):
+    with open(file_name, 'wb') as h_out:
+        np.savez_compressed(h_out, **contacts)
+
+
+def read_contacts(file_name, contigs):
+    """Read a contact table, registering its contigs.
+
+    :return: contact table as a dict of column arrays
+    """
+    data = np.load(file_name)
+    contacts = dict((n, data[n]) for n in data.files)
+    contacts['alts'] = bool(contacts['alts'])
+    for name, length in zip(contacts['contig_name'], contacts['contig_length']):
+        contigs.add(str(name), int(length))
+    return contacts
+
+
+def contact_edges(contacts, counter, args):
+    """Count the edges of a contact table under the alignment constraints of the command line
+    arguments, as record_contigs would have applied them while scanning.
+
+    :param contacts: contact table
+    :param counter: edge counter
+    :param args: command line arguments
+    :return: dict of accept/reject counts
+    """
+    alt = contacts['alt']
+    if args.strong:
+        record_ok = contacts['good'] & (contacts['match'] >= args.strong) & (contacts['mapq'] >= args.mapq)
+        alt_ok = contacts['alt_good'] & (contacts['alt_match'] >= args.strong)
+    else:
+        record_ok = np.ones(len(alt), dtype=bool)
+        alt_ok = contacts['alt_good']
+
+    stats = new_stats()
+    stats['reject'] = np.sum(~alt & ~record_ok)
+    stats['accept'] = np.sum(~alt & record_ok)
+
+    keep = record_ok & ~alt
+    if args.recover_alts:
+        stats['alt_ok'] = np.sum(alt & record_ok & alt_ok)
+        stats['alt_rej'] = np.sum(alt & record_ok & ~alt_ok)
+        keep |= record_ok & alt & alt_ok
+
+    # a record links to each contig once, even if also listed amongst its alternates
+    keep = np.flatnonzero(keep)
+    key = (contacts['record'][keep] << 32) | contacts['contig'][keep]
+    keep = keep[np.unique(key, return_index=True)[1]]
+
+    count_linkage_table(contacts['insert'][keep], contacts['direction'][keep],
+                        contacts['contig'][keep].astype(np.int64), counter)
+    return stats
+
+
+def sort_order(bf):
+    try:
+        return bf.header['HD']['SO']
+    except KeyError:
+        return 'unknown'
+
+
+def write_tables(contigs, counter, args):
+    """Write the edge and node tables, and if requested a graphml file, from the accumulated
+    edge weights.
+    """
+    u, v, w = counter.edges()
+
+    # prune self-loops edges from ligation products
+    keep = u != v
+    u, v, w = u[keep], v[keep], w[keep]
+
+    lengths = np.array(contigs.lengths, dtype=np.int64)
+    print 'paired={0} order={1} size={2}'.format(counter.total, len(contigs), len(u))
+
+    # if requested, add weight=1 self-loop to each node.
+    # can be necessary when representing graphs in some formats for isolated nodes.
+    if args.add_selfloops:
+        ids = np.arange(len(contigs), dtype=np.int64)
+        u = np.concatenate((u, ids))
+        v = np.concatenate((v, ids))
+        w = np.concatenate((w, np.ones(len(ids), dtype=np.int64)))
+
+    # filter nodes on length
+    keep_node = lengths >= args.minlen
+    keep = keep_node[u] & keep_node[v]
+    u, v, w = u[keep], v[keep], w[keep]
+    node_ids = np.flatnonzero(keep_node)
+    names = contigs.names
+
+    if args.graphml is not None:
+        import networkx as nx
+        g = nx.Graph()
+        for i in node_ids:
+            g.add_node(names[i], length=lengths[i])
+        for i in xrange(len(u)):
+            g.add_edge(names[u[i]], names[v[i]], weight=w[i])
+        nx.write_graphml(g, args.graphml[0])
+
+    # edges refer to nodes by their row in the node table
+    node_row = np.cumsum(keep_node) - 1
+    graph_tables.write_tables(args.edge_csv[0], args.node_csv[0], [names[i] for i in node_ids], lengths[node_ids],
+                              node_row[u], node_row[v], w, fmt=args.table_fmt)
 
 
 if __name__ == '__main__':
@@ -171,7 +884,8 @@ if __name__ == '__main__':
     parser.add_argument('--recover-alts', action='store_true', default=False,
                         help='Recover the alternate alignments from BAM')
     parser.add_argument('--sim', default=False, action='store_true', help='Hi-C simulation read names')
-    parser.add_argument('--afmt', choices=['bam', 'psl'], default='bam', help='Alignment file format (bam)')
+    parser.add_argument('--afmt', choices=['bam', 'psl', 'contacts'], default='bam',
+                        help='Alignment file format, or a previously saved contact table (bam)')
     parser.add_argument('--minid', type=float, required=False, default=95.0,
                         help='Minimum percentage identity for alignment (95)')
     parser.add_argument('--minlen', type=int, required=False, default=0,
@@ -185,9 +899,24 @@ if __name__ == '__main__':
     parser.add_argument('--mapq', default=60, type=int, help='Minimum mapping quality [60]')
     parser.add_argument('--strong', default=None, type=int,
                         help='Accept only mapped reads with no disagreements only clipping')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='BAM files are grouped by read name (collated or queryname sorted), process them '
+                             'as a stream in bounded memory. Split R1/R2 files must both be queryname sorted')
+    parser.add_argument('--threads', default=1, type=int,
+                        help='Threads used in BGZF decompression of BAM files [1]')
+    parser.add_argument('-p', '--processes', default=1, type=int,
+                        help='Scan indexed BAM files in parallel by region across processes [1]')
+    parser.add_argument('--save-contacts', metavar='NPZ',
+                        help='Save a contact table of all placed reads, from which edges can later be produced '
+                             'under any alignment constraints with --afmt contacts. Alternate alignments are '
+                             'included with --recover-alts')
     parser.add_argument('--graphml', nargs=1, help='Write graphml file')
+    parser.add_argument('--table-fmt', choices=graph_tables.FORMATS, default='csv',
+                        help='Edge and node table format, text or columnar numpy archive [csv]')
     parser.add_argument('--split', metavar='BAM', nargs=2, help='Split R1/R2 HiC to contigs bam files')
     parser.add_argument('--merged', metavar='BAM', nargs=1, help='Single merged HiC to contigs bam file')
+    parser.add_argument('--psl', dest='hic2ctg', metavar='PSL', nargs=1, help='HiC to contigs psl file')
+    parser.add_argument('--contacts', metavar='NPZ', nargs=1, help='Contact table file')
     parser.add_argument('edge_csv', metavar='EDGE_CSV', nargs=1, help='Edges csv output file')
     parser.add_argument('node_csv', metavar='NODE_CSV', nargs=1, help='Nodes csv output file')
     args = parser.parse_args()
@@ -195,8 +924,8 @@ if __name__ == '__main__':
     # TODO We dont need to reference this file.
     # TODO If a scaffold does not appear in HiC data then it is not correct to introduce it.
 
-    g = nx.Graph()
-    linkage_map = {}
+    contigs = ContigRegistry()
+    counter = EdgeCounter()
 
     # input is a BAM file
     if args.afmt == 'bam':
@@ -215,207 +944,125 @@ if __name__ == '__main__':
 
         bam_files = args.split if args.split else args.merged
 
-        alt_rej = 0
-        alt_ok = 0
-        reject = 0
-        accept = 0
-        for rdir, fn in enumerate(bam_files, start=1):
-            print 'Parsing {0}...'.format(fn)
-
-            # rdir = 'fwd' if R == 1 else 'rev'
-
-            with pysam.AlignmentFile(fn, 'rb') as bf:
-                for i in xrange(len(bf.references)):
-                    rn = bf.references[i]
-                    if rn not in g:
-                        g.add_node(rn, length=bf.lengths[i])
-
-            # Read the sam file and build a linkage map
-            with pysam.AlignmentFile(fn, 'rb') as bf:
-                iter_bam = bf.fetch()
-                for mr in iter_bam:
-
-                    contig_set = set()
-
-                    if mr.reference_id == -1:
-                        reject += 1
-                        continue
-
-                    # apply the constraints on alignment coverage and percent identity
-                    if args.strong and not strong_match(mr, args.strong, True, args.mapq):
-                        reject += 1
-                        continue
-                    #else:
-                    #    perid = dict(mr.cigartuples)[0] / float(mr.query_length) * 100.0
-                    #    cov = mr.query_alignment_length / float(mr.query_length)
-                    #    if cov < args.mincov or perid < args.minid:
-                    #        reject += 1
-                    #        continue
-
-                    accept += 1
-
-                    if args.sim:
-                        read = mr.query_name[:-3]
-                        suffix = mr.query_name[-3:]
-                        if suffix == 'fwd':
-                            rdir = 0
-                        elif suffix == 'rev':
-                            rdir = 1
-                        else:
-                            raise IOError('simulated read names must end in "fwd" or "rev"')
-                    else:
-                        read = mr.query_name
-
-                    # contig that this alignment line refers to directly
-                    contig_set.add(bf.getrname(mr.reference_id))
-
-                    # if requested, add also alternate alignment contigs for linkage map
-                    if args.recover_alts:
-                        try:
-                            # XA field contains alternate alignments for read, semi-colon delimited
-                            alts_field = mr.get_tag('XA')
-                            hit_list = alts_field.split(';')
-
-                            for hit in hit_list:
-                                try:
-                                    hrec = hit.rstrip(';').split(',')
-                                    if len(hrec) == 1 and not hrec[0]:
-                                        continue
-
-                                    ctg, pos, cig, nm = hrec
-
-                                    if int(nm) > 0 or not good_match(cigar_to_tuple(cig), args.strong, True):
-                                        alt_rej += 1
-                                        continue
-
-                                    contig_set.add(ctg)
-                                    alt_ok += 1
-
-                                except Exception as e:
-                                    print e
-                                    raise IOError('alternate alignment did not contain four fields. [{0}] {1}'.format(
-                                            alts_field, hit))
-
-                        except KeyError:
-                            pass
-
-                    ctg_assocs = [(ctg, rdir) for ctg in contig_set]
-
-                    linkage = linkage_map.get(read)
-                    if linkage is None:
-                        linkage_map[read] = ctg_assocs
-                    else:
-                        linkage.extend(ctg_assocs)
-
-                print 'For {0} -- rejected {1} accepted {2}, rejection rate={3:.1f}%'.format(
-                        fn, reject, accept, float(reject) / (reject + accept) * 100.)
-
-        print 'Overall: rejected {0} accepted {1}, rejection rate={2:.1f}%'.format(
-                reject, accept, float(reject) / (reject + accept) * 100.)
-        print 'Recover alts: rejected {0} accepted {1} rate={2:.1f}%'.format(
-                alt_rej, alt_ok, float(alt_rej) / (alt_rej + alt_ok))
-
-    # input is a PSL file
-    elif args.afmt == 'psl':
+        if args.stream and args.processes > 1:
+            print 'Error: streaming input cannot be scanned by region in parallel'
+            sys.exit(1)
 
-        if args.recover_alts:
-            print 'Recovering alternate alignments is only applicable to BAM file parsing'
+        if args.save_contacts and (args.stream or args.processes > 1):
+            print 'Error: contact tables are built by a serial scan'
             sys.exit(1)
 
-        # line marks a non-header line
-        psl_dataline = re.compile(r'^[0-9]+\t')
+        stats = new_stats()
 
-        with open(args.hic2ctg[0], 'r') as h_in:
-            for line in h_in:
+        if args.save_contacts:
 
-                # skip header fields
-                if not psl_dataline.match(line):
-                    continue
+            contacts = scan_contacts(bam_files, contigs, args)
+            write_contacts(args.save_contacts, contacts)
+            print 'Creating graph from contact table'
+            stats = contact_edges(contacts, counter, args)
 
-                fields = line.rsplit()
+        elif args.stream:
 
-                # qname = fields[9]
-                # assumed naming convention of HiC simulated reads.
-                read, rdir = split_name(fields[9])
+            bam_handles = [pysam.AlignmentFile(fn, 'rb', threads=args.threads) for fn in bam_files]
+            for fn, bf in zip(bam_files, bam_handles):
+                if sort_order(bf) == 'coordinate':
+                    print 'Error: {0} is coordinate sorted, streaming requires grouping by read name'.format(fn)
+                    sys.exit(1)
+                # collated files share no read order, so split files could not be joined by it
+                if len(bam_files) == 2 and sort_order(bf) != 'queryname':
+                    print 'Error: {0} is not sorted by queryname, streaming split files requires both to be ' \
+                          'sorted by queryname with the same tool'.format(fn)
+                    sys.exit(1)
 
-                contig = fields[13]
-                alen = int(fields[12]) - int(fields[11]) + 1
-                qlen = int(fields[10])
+            print 'Streaming {0}...'.format(', '.join(bam_files))
+            groups = [iter_read_groups(bf, rdir, contigs, args, stats)
+                      for rdir, bf in enumerate(bam_handles, start=1)]
+            if len(groups) == 2:
+                groups = join_read_groups(*groups)
+            else:
+                groups = groups[0]
 
-                # Taken from BLAT perl script for calculating percentage identity
-                matches = int(fields[0])
-                mismatches = int(fields[1])
-                repmatches = int(fields[2])
-                q_num_insert = int(fields[4])
-                perid = (1.0 - float(mismatches + q_num_insert) / float(matches + mismatches + repmatches)) * 100.0
+            for read, linkages in groups:
+                count_linkages(linkages, counter)
 
-                if not g.has_node(contig):
-                    g.add_node(contig, length=int(fields[14]))
+            for bf in bam_handles:
+                bf.close()
 
-                # ignore alignment records which fall below mincov or minid
-                # wrt the length of the alignment vs query sequence.
-                if float(alen) / float(qlen) < args.mincov or perid < args.minid:
-                    continue
+        elif args.processes > 1:
 
-                linkage = linkage_map.get(read)
-                if linkage is None:
-                    linkage_map[read] = [(contig, rdir)]
-                else:
-                    linkage.append((contig, rdir))
+            file_stats = parallel_edges(bam_files, contigs, counter, args, stats)
+            for fn, fs in zip(bam_files, file_stats):
+                print 'For {0} -- rejected {1} accepted {2}, rejection rate={3:.1f}%'.format(
+                        fn, fs['reject'], fs['accept'], float(fs['reject']) / (fs['reject'] + fs['accept']) * 100.)
+
+        else:
+
+            linkage_map = {}
+            for rdir, fn in enumerate(bam_files, start=1):
+                print 'Parsing {0}...'.format(fn)
+
+                # Read the sam file and build a linkage map
+                with pysam.AlignmentFile(fn, 'rb', threads=args.threads) as bf:
+                    tid_map = register_references(bf, contigs)
+                    fs = new_stats()
+                    add_linkages(bf.fetch(), rdir, tid_map, contigs, args, fs, linkage_map)
+                    add_stats(stats, fs)
+                    print 'For {0} -- rejected {1} accepted {2}, rejection rate={3:.1f}%'.format(
+                            fn, fs['reject'], fs['accept'], float(fs['reject']) / (fs['reject'] + fs['accept']) * 100.)
+
+            # From the set of all linkages, convert this information
+            # into inter-contig edges, where the nodes are contigs.
+            # Count the number of redundant links as a raw edge weight.
+            print 'Creating graph from linkage map'
+            for insert, linkages in linkage_map.iteritems():
+                count_linkages(linkages, counter)
 
-    # From the set of all linkages, convert this information
-    # into inter-contig edges, where the nodes are contigs.
-    # Count the number of redundant links as a raw edge weight.
-    print 'Creating graph from linkage map'
-    edge_map = {}
-    paired = 0
-    total = 0
-    for insert, linkages in linkage_map.iteritems():
-        n_links = len(linkages)
-        for i in xrange(n_links):
-            for j in xrange(i+1, n_links):
-
-                u, udir = linkages[i]
-                v, vdir = linkages[j]
-
-                if udir == vdir:
-                    # linkages only between opposing directions of ligation product
-                    continue
+        print 'Overall: rejected {0} accepted {1}, rejection rate={2:.1f}%'.format(
+                stats['reject'], stats['accept'], float(stats['reject']) / (stats['reject'] + stats['accept']) * 100.)
+        if args.recover_alts:
+            print 'Recover alts: rejected {0} accepted {1} rate={2:.1f}%'.format(
+                    stats['alt_rej'], stats['alt_ok'],
+                    float(stats['alt_rej']) / (stats['alt_rej'] + stats['alt_ok']) * 100.)
 
-                if g.has_edge(u, v):
-                    g[u][v]['weight'] += 1
-                else:
-                    g.add_edge(u, v, weight=1)
+    # input is a contact table from an earlier scan
+    elif args.afmt == 'contacts':
 
-                paired += 1
+        if not args.strong and args.recover_alts:
+            print 'Recover alts can only be used with strong matching'
+            sys.exit(1)
 
-    # prune self-loops edges from ligation products
-    g.remove_edges_from(g.selfloop_edges())
+        if not args.contacts:
+            print 'Error: contact input requires a contact table file'
+            sys.exit(1)
 
-    print 'paired={0} order={1} size={2}'.format(paired, g.order(), g.size())
+        print 'Reading {0}...'.format(args.contacts[0])
+        contacts = read_contacts(args.contacts[0], contigs)
+        if args.recover_alts and not contacts['alts']:
+            print 'Error: {0} was built without alternate alignments, rebuild it with --recover-alts'.format(
+                args.contacts[0])
+            sys.exit(1)
+        stats = contact_edges(contacts, counter, args)
+        print 'Overall: rejected {0} accepted {1}, rejection rate={2:.1f}%'.format(
+                stats['reject'], stats['accept'], float(stats['reject']) / (stats['reject'] + stats['accept']) * 100.)
+        if args.recover_alts:
+            print 'Recover alts: rejected {0} accepted {1} rate={2:.1f}%'.format(
+                    stats['alt_rej'], stats['alt_ok'],
+                    float(stats['alt_rej']) / (stats['alt_rej'] + stats['alt_ok']) * 100.)
 
-    # if requested, add weight=1 self-loop to each node.
-    # can be necessary when representing graphs in some formats for isolated nodes.
-    if args.add_selfloops:
-        for v in g.nodes():
-            if not g.has_edge(v, v):
-                g.add_edge(v, v, weight=1)
+    # input is a PSL file
+    elif args.afmt == 'psl':
 
-    # filter nodes on length
-    nlist = g.nodes()
-    for n in nlist:
-        if g.node[n]['length'] < args.minlen:
-            g.remove_node(n)
+        if args.recover_alts:
+            print 'Recovering alternate alignments is only applicable to BAM file parsing'
+            sys.exit(1)
 
-    if args.graphml is not None:
-        nx.write_graphml(g, args.graphml[0])
+        if not args.hic2ctg:
+            print 'Error: PSL input requires a HiC to contigs PSL file'
+            sys.exit(1)
 
-    with open(args.edge_csv[0], 'w') as h_out:
-        h_out.write("SOURCE TARGET RAWWEIGHT TYPE\n")
-        for u, v, dat in g.edges(data=True):
-            h_out.write('{0} {1} {2} UNDIRECTED\n'.format(u, v, dat['weight']))
+        print 'Parsing {0}...'.format(args.hic2ctg[0])
+        stats = psl_linkages(args.hic2ctg[0], contigs, counter, args)
+        print 'Overall: rejected {0} accepted {1}, rejection rate={2:.1f}%'.format(
+                stats['reject'], stats['accept'], float(stats['reject']) / (stats['reject'] + stats['accept']) * 100.)
 
-    with open(args.node_csv[0], 'w') as h_out:
-        h_out.write('ID LENGTH\n')
-        for v, dat in g.nodes(data=True):
-            h_out.write('{0} {1[length]}\n'.format(v, dat))
+    write_tables(contigs, counter, args)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Alignment statistics derived from CIGARs, shared by the alignment filters.
+
+For each distinct CIGAR, the number of matching bases, the total extent of all operations,
+the leading operation and the set of operations present are computed once and remembered.
+As reads of similar length produce relatively few distinct CIGARs, the per-read cost is then
+little more than a dictionary lookup. Data with many distinct CIGARs, such as long or indel-rich
+reads, would grow the memo without limit, so it is cleared whenever it reaches MEMO_SIZE entries.
+
+Run as a script to benchmark the per-read cost against direct summation over CIGAR tuples.
+"""
+from collections import namedtuple
+import time
+
+import numpy as np
+
+# CIGAR operation codes, as used by pysam
+MATCH, INS, DEL, REF_SKIP, SOFT_CLIP, HARD_CLIP, PAD, EQUAL, DIFF, BACK = range(10)
+CIGAR_OPS = 'MIDNSHP=XB'
+CODE2CIGAR = dict((op, code) for code, op in enumerate(CIGAR_OPS))
+
+"""
+Statistics of a single CIGAR.
+
+match: number of bases in M operations
+length: total extent of all operations
+first_op: code of the leading operation, -1 for an empty CIGAR
+op_mask: bit mask of the operation codes present
+"""
+CigarStats = namedtuple('CigarStats', ['match', 'length', 'first_op', 'op_mask'])
+
+EMPTY_STATS = CigarStats(0, 0, -1, 0)
+
+# statistics by CIGAR string, and the most entries it may hold
+_MEMO = {'*': EMPTY_STATS, '': EMPTY_STATS}
+MEMO_SIZE = 100000
+
+
+def op_mask(codes):
+    """
+    :param codes: iterable of operation codes
+    :return: bit mask of the codes
+    """
+    mask = 0
+    for c in codes:
+        mask |= 1 << c
+    return mask
+
+
+def tuple_stats(cigartuples):
+    """
+    Compute statistics by walking a list of (operation, length) tuples.
+
+    :param cigartuples: CIGAR as a list of (operation, length)
+    :return: CigarStats
+    """
+    if not cigartuples:
+        return EMPTY_STATS
+    match = 0
+    length = 0
+    mask = 0
+    for op, n in cigartuples:
+        if op == MATCH:
+            match += n
+        length += n
+        mask |= 1 << op
+    return CigarStats(match, length, cigartuples[0][0], mask)
+
+
+def parse_cigar(cigar):
+    """
+    Convert a CIGAR string to a list of (operation, length) tuples, without regular expressions.
+
+    :param cigar: CIGAR string
+    :return: list of (operation, length)
+    """
+    tuples = []
+    n = 0
+    for ch in cigar:
+        if ch.isdigit():
+            n = n * 10 + ord(ch) - 48
+        else:
+            tuples.append((CODE2CIGAR[ch], n))
+            n = 0
+    return tuples
+
+
+def _remember(cigar, st):
+    """
+    Memoise the statistics of a CIGAR, first clearing the memo if it is full.
+    """
+    if len(_MEMO) >= MEMO_SIZE:
+        _MEMO.clear()
+        _MEMO['*'] = _MEMO[''] = EMPTY_STATS
+    _MEMO[cigar] = st
+    return st
+
+
+def string_stats(cigar):
+    """
+    Statistics of a CIGAR string, computed once per distinct string.
+
+    :param cigar: CIGAR string
+    :return: CigarStats
+    """
+    st = _MEMO.get(cigar)
+    if st is None:
+        st = _remember(cigar, tuple_stats(parse_cigar(cigar)))
+    return st
+
+
+def _segment_stats(read):
+    """
+    Compute statistics of an aligned segment, preferring pysam's own cigar statistics.
+    """
+    if hasattr(read, 'get_cigar_stats'):
+        nt, blocks = read.get_cigar_stats()
+        return CigarStats(int(nt[MATCH]), int(np.sum(nt[:BACK + 1])), read.cigartuples[0][0],
+                          op_mask(np.flatnonzero(blocks[:BACK + 1])))
+    return tuple_stats(read.cigartuples)
+
+
+def read_stats(read):
+    """
+    Statistics of a pysam aligned segment, computed once per distinct CIGAR.
+
+    :param read: pysam.AlignedSegment
+    :return: CigarStats, or None if the read has no CIGAR
+    """
+    cigar = read.cigarstring
+    if cigar is None:
+        return None
+    st = _MEMO.get(cigar)
+    if st is None:
+        st = _remember(cigar, _segment_stats(read))
+    return st
+
+
+def coverage(st):
+    """
+    :param st: CigarStats
+    :return: fraction of the CIGAR's extent which are matches
+    """
+    return float(st.match) / st.length
+
+
+def read_table(reads):
+    """
+    Statistics of many aligned segments in bulk.
+
+    :param reads: iterable of pysam.AlignedSegment
+    :return: structured array of mapq, match and length, where reads without a CIGAR have
+    a match and length of -1
+    """
+    table = []
+    for read in reads:
+        st = read_stats(read)
+        if st is None:
+            table.append((read.mapping_quality, -1, -1))
+        else:
+            table.append((read.mapping_quality, st.match, st.length))
+    return np.array(table, dtype=[('mapq', np.int32), ('match', np.int64), ('length', np.int64)])
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(description='Benchmark the per-read cost of CIGAR statistics')
+    parser.add_argument('-n', type=int, default=1000000, help='Number of synthetic reads [1000000]')
+    parser.add_argument('--bam', help='Use the first N reads of a BAM file rather than synthetic reads')
+    args = parser.parse_args()
+
+    if args.bam:
+        import pysam
+        with pysam.AlignmentFile(args.bam, 'rb') as bf:
+            cigars = []
+            for read in bf.fetch(until_eof=True):
+                if read.cigarstring is not None:
+                    cigars.append(read.cigarstring)
+                if len(cigars) >= args.n:
+                    break
+    else:
+        # typical of 150bp reads: mostly full matches with clipping of varying extent
+        rs = random.Random(0)
+        cigars = []
+        for i in xrange(args.n):
+            clip = rs.choice([0, 0, 0, 0, rs.randint(1, 75)])
+            if clip == 0:
+                cigars.append('150M')
+            else:
+                cigars.append(rs.choice(['{0}S{1}M', '{1}M{0}S']).format(clip, 150 - clip))
+
+    print 'Reads: {0} distinct CIGARs: {1}'.format(len(cigars), len(set(cigars)))
+
+    tuples = [parse_cigar(c) for c in cigars]
+    t0 = time.time()
+    for ct in tuples:
+        mlen = float(sum([cig_i[1] for cig_i in ct if cig_i[0] == 0]))
+        rlen = float(sum([cig_i[1] for cig_i in ct]))
+    t_sum = time.time() - t0
+
+    t0 = time.time()
+    for ct in tuples:
+        st = tuple_stats(ct)
+    t_walk = time.time() - t0
+
+    t0 = time.time()
+    for c in cigars:
+        st = string_stats(c)
+    t_memo = time.time() - t0
+
+    for label, t in [('list sums', t_sum), ('tuple walker', t_walk), ('memoised', t_memo)]:
+        print '{0:<14} {1:.3f} us/read'.format(label, t / len(cigars) * 1e6)
@@ -6,9 +6,10 @@ import operator
 import argparse
 import contextlib
 
-import pandas
 import networkx
 
+import graph_tables
+
 
 def write_metis(G, metis_file, nodemap_file):
     """Metis format
@@ -73,8 +74,8 @@ parser.add_argument('-f', '--fmt', dest='format', default='metis', choices=['met
                     help='Output graph format')
 parser.add_argument('--scale-weights', type=float, metavar='FLOAT',
                     help='Scale factor for weights for metis (integer weights only)')
-parser.add_argument('edges', metavar='EDGE_CSV', nargs=1, help='Edge csv file')
-parser.add_argument('nodes', metavar='NODE_CSV', nargs=1, help='Node csv file')
+parser.add_argument('edges', metavar='EDGE_CSV', nargs=1, help='Edge csv or npz file')
+parser.add_argument('nodes', metavar='NODE_CSV', nargs=1, help='Node csv or npz file')
 parser.add_argument('output', metavar='GRAPH_OUT', nargs=1, help='Output file')
 parser.add_argument('node_map', metavar='NODEMAP_FILE', nargs='?', help='Output node-map file')
 args = parser.parse_args()
@@ -87,8 +88,8 @@ try:
     minLength = args.minlen
 
     # load table of edges
-    edgeTable = pandas.read_csv(args.edges[0], sep=' ', dtype={'SOURCE': str, 'TARGET': str, 'RAWWEIGHT': float})
-    nodeTable = pandas.read_csv(args.nodes[0], sep=' ', dtype={'ID': str, 'LENGTH': int})
+    edgeTable, nodeTable = graph_tables.read_tables(args.edges[0], args.nodes[0])
+    edgeTable.RAWWEIGHT = edgeTable.RAWWEIGHT.astype(float)
 
     if args.scale_weights:
         edgeTable.RAWWEIGHT *= args.scale_weights
@@ -106,20 +107,10 @@ try:
     filteredIDs = nodeTable[nodeTable.LENGTH > minLength].ID
     filteredEdges = edgeTable[edgeTable.TARGET.isin(filteredIDs) & edgeTable.SOURCE.isin(filteredIDs)]
 
-    # for each node, get the list of neighbours and their raw weights
-    ndict = {}
-    for n in filteredIDs:
-        links = {}
-        # the neighbours of node 'n' when listed as TARGETs
-        for e in filteredEdges[filteredEdges.SOURCE == n][['TARGET', 'RAWWEIGHT']].itertuples():
-            links[e[1]] = {'weight': float(e[2])}
-        # the neighbours of node 'n' when listed as SOURCEs
-        for e in filteredEdges[filteredEdges.TARGET == n][['SOURCE', 'RAWWEIGHT']].itertuples():
-            links[e[1]] = {'weight': float(e[2])}
-        ndict[n] = links
-
-    # convert this dict of dicts into a graph object
-    G = networkx.from_dict_of_dicts(ndict)
+    # build the graph from all retained nodes and the edges between them
+    G = networkx.Graph()
+    G.add_nodes_from(filteredIDs)
+    G.add_weighted_edges_from(filteredEdges[['SOURCE', 'TARGET', 'RAWWEIGHT']].itertuples(index=False))
 
     if args.format == 'metis':
         write_metis(G, args.output[0], args.node_map)
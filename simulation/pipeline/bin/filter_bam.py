@@ -1,56 +1,153 @@
 #!/usr/bin/env python
 import sys
+import multiprocessing as mp
 import pysam
 import argparse
 
-parser = argparse.ArgumentParser(description='Filter BAM/SAM files for read coverage and mapping quality')
-parser.add_argument('-s', dest='sam_input', default=False, action='store_true', help='Input is ASCII SAM format')
-parser.add_argument('--mincov', type=float, default=0.95, help='Minimum coverage of aligned read [0..1]')
-parser.add_argument('--minqual', type=int, default=40, help='Minimum mapping quality score of aligned read [40]')
-parser.add_argument('input', metavar='INPUT_FILE', nargs=1, help='Input BAM/SAM file')
-parser.add_argument('output', metavar='OUTPUT_FILE', nargs=1, help='Output BAM file')
-args = parser.parse_args()
+import cigar_stats
 
-# set these here to eliminate some deferencing in the callback
-min_cov = args.mincov
-min_mapq = args.minqual
 
-# Set input mode based commandline option
-input_mode = 'r' if args.sam_input else 'rb'
-infile = pysam.AlignmentFile(args.input[0], input_mode)
-outfile = pysam.AlignmentFile(args.output[0], 'wb', template=infile)
+def filter_grid(in_file, targets, sam_input=False, threads=1, index=False):
+    """
+    Exclude reads which do not meet the minimum coverage and mapping quality of each target.
+    Write successful reads to the target's output bam file.
+
+    All targets are filtered in a single pass over the input, so a grid of thresholds
+    costs one read of the input rather than one per combination.
 
-kept = 0
-total = 0
+    Coverage is determined by directly counting up matching regions in the
+    CIGAR string and comparing that to the total extent reported in the
+    CIGAR. These statistics are shared by all reads with the same CIGAR.
 
+    Unplaced reads can never be kept and are not counted in the total, as
+    they are not visited when fetching from an indexed BAM file.
 
-def keepers_callback(read):
+    :param in_file: input BAM/SAM file
+    :param targets: list of (min_cov, min_mapq, out_file), where min_cov is the minimum
+    coverage of aligned read [0..1] and min_mapq the minimum mapping quality
+    :param sam_input: input is ASCII SAM format
+    :param threads: threads used in BGZF compression and decompression
+    :param index: index the outputs, which is possible when the input is coordinate sorted
+    :return: (list of kept per target, total placed reads)
+    """
+    kept = [0] * len(targets)
+    total = 0
+
+    # Set input mode based commandline option
+    input_mode = 'r' if sam_input else 'rb'
+    with pysam.AlignmentFile(in_file, input_mode, threads=threads) as infile:
+
+        try:
+            is_sorted = infile.header['HD']['SO'] == 'coordinate'
+        except KeyError:
+            is_sorted = False
+        if index and not is_sorted:
+            print 'Warning: {0} is not coordinate sorted, output will not be indexed'.format(in_file)
+            index = False
+
+        outfiles = [pysam.AlignmentFile(out_file, 'wb', template=infile, threads=threads)
+                    for min_cov, min_mapq, out_file in targets]
+        try:
+            thresholds = [(min_cov, min_mapq) for min_cov, min_mapq, out_file in targets]
+            for read in infile.fetch(until_eof=True):
+                if read.reference_id == -1:
+                    continue
+                total += 1
+                st = cigar_stats.read_stats(read)
+                if st is None:
+                    continue
+                cov = cigar_stats.coverage(st)
+                mapq = read.mapping_quality
+                for i, (min_cov, min_mapq) in enumerate(thresholds):
+                    if cov >= min_cov and mapq >= min_mapq:
+                        kept[i] += 1
+                        outfiles[i].write(read)
+        finally:
+            for outfile in outfiles:
+                outfile.close()
+
+    # filtering preserves order, so sorted input produces sorted output
+    if index:
+        for min_cov, min_mapq, out_file in targets:
+            pysam.index(out_file)
+
+    return kept, total
+
+
+def filter_reads(in_file, out_file, min_cov, min_mapq, sam_input=False, threads=1, index=False):
     """
     Exclude reads which do not meet the minimum coverage and mapping quality.
     Write successful reads to output bam file.
 
-    Coverage is determined by directly counting up matching regions in the
-    CIGAR string and comparing that to the total extent reported in the
-    CIGAR.
+    :param in_file: input BAM/SAM file
+    :param out_file: output BAM file
+    :param min_cov: minimum coverage of aligned read [0..1]
+    :param min_mapq: minimum mapping quality of aligned read
+    :param sam_input: input is ASCII SAM format
+    :param threads: threads used in BGZF compression and decompression
+    :param index: index the output, which is possible when the input is coordinate sorted
+    :return: (kept, total placed reads)
+    """
+    kept, total = filter_grid(in_file, [(min_cov, min_mapq, out_file)], sam_input, threads, index)
+    return kept[0], total
 
-    Note: this should be a callback, but callbacks do not appear to be invokved
-    with fetch in pysam -- despite the documentation saying otherwise.
 
-    :param read: pysam.AlignedSegment
-    """
-    global kept, total, outfile
-    if read.cigarstring is not None:
-        mlen = float(sum([cig_i[1] for cig_i in read.cigartuples if cig_i[0] == 0]))
-        rlen = float(sum([cig_i[1] for cig_i in read.cigartuples]))
-        if mlen/rlen >= min_cov and read.mapping_quality >= min_mapq:
-            kept += 1
-            outfile.write(read)
-    total += 1
-
-for read in infile.fetch():
-    keepers_callback(read)
-
-infile.close()
-outfile.close()
-
-print 'Kept {0} of {1} {2:.1f}%'.format(kept, total, 100.0*kept/total)
+def _filter_worker(job):
+    return filter_grid(*job)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Filter BAM/SAM files for read coverage and mapping quality')
+    parser.add_argument('-s', dest='sam_input', default=False, action='store_true', help='Input is ASCII SAM format')
+    parser.add_argument('--mincov', type=float, default=0.95, help='Minimum coverage of aligned read [0..1]')
+    parser.add_argument('--minqual', type=int, default=40, help='Minimum mapping quality score of aligned read [40]')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Threads used in BGZF compression and decompression, per file [1]')
+    parser.add_argument('--index', default=False, action='store_true',
+                        help='Index output files, requires coordinate sorted input')
+    parser.add_argument('--grid', metavar=('MINCOV', 'MINQUAL', 'OUTPUT_FILE'), nargs=3, action='append',
+                        default=[], help='Additionally write the reads of INPUT_FILE which satisfy these thresholds '
+                                         'to OUTPUT_FILE, in the same pass. May be given more than once')
+    parser.add_argument('--pair', metavar=('INPUT_FILE', 'OUTPUT_FILE'), nargs=2, action='append', default=[],
+                        help='Additional input and output files to filter concurrently, such as R2 of a split '
+                             'R1/R2 pair. May be given more than once, but not together with --grid')
+    parser.add_argument('input', metavar='INPUT_FILE', nargs=1, help='Input BAM/SAM file')
+    parser.add_argument('output', metavar='OUTPUT_FILE', nargs=1, help='Output BAM file')
+    args = parser.parse_args()
+
+    # output names of the threshold grid cannot be derived for additional pairs
+    if args.grid and args.pair:
+        print 'Error: --grid and --pair cannot be used together'
+        sys.exit(1)
+
+    targets = [(args.mincov, args.minqual, args.output[0])]
+    for min_cov, min_qual, out_file in args.grid:
+        targets.append((float(min_cov), int(min_qual), out_file))
+    jobs = [(args.input[0], targets)]
+    for in_file, out_file in args.pair:
+        jobs.append((in_file, [(args.mincov, args.minqual, out_file)]))
+
+    out_files = [t[2] for in_file, job_targets in jobs for t in job_targets]
+    if len(set(out_files)) != len(out_files):
+        print 'Error: output files must differ'
+        sys.exit(1)
+
+    jobs = [(in_file, job_targets, args.sam_input, args.threads, args.index) for in_file, job_targets in jobs]
+
+    if len(jobs) == 1:
+        results = [filter_grid(*jobs[0])]
+    else:
+        pool = mp.Pool(len(jobs))
+        try:
+            results = pool.map(_filter_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    for job, (kept, total) in zip(jobs, results):
+        in_file, job_targets = job[:2]
+        for (min_cov, min_mapq, out_file), n in zip(job_targets, kept):
+            if len(out_files) > 1:
+                print '{0} -> {1}:'.format(in_file, out_file),
+            print 'Kept {0} of {1} {2:.1f}%'.format(n, total, 100.0*n/total)
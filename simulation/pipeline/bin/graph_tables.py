@@ -0,0 +1,83 @@
+"""
+Edge and node tables of contig graphs.
+
+Tables are written either as space-delimited text or as a compact columnar numpy archive (npz).
+In an archive, the node table is a dictionary of contig names and lengths, and edges refer to
+nodes by their integer index in that dictionary. Readers recognise the format from the file
+content, so file names need not change.
+"""
+import numpy as np
+import pandas as pd
+
+# leading bytes of a zip archive, as written by numpy.savez
+NPZ_MAGIC = 'PK\x03\x04'
+
+FORMATS = ['csv', 'npz']
+
+
+def is_npz(file_name):
+    with open(file_name, 'rb') as h_in:
+        return h_in.read(len(NPZ_MAGIC)) == NPZ_MAGIC
+
+
+def write_tables(edge_file, node_file, names, lengths, source, target, weight, fmt='csv'):
+    """
+    Write edge and node tables.
+
+    :param edge_file: edge table output file
+    :param node_file: node table output file
+    :param names: node names
+    :param lengths: node lengths
+    :param source: edge source nodes, as indices into names
+    :param target: edge target nodes, as indices into names
+    :param weight: raw edge weights
+    :param fmt: table format, 'csv' or 'npz'
+    """
+    if fmt == 'npz':
+        # file handles are used as savez would otherwise append an extension
+        with open(node_file, 'wb') as h_out:
+            np.savez_compressed(h_out, id=np.array(names), length=np.asarray(lengths, dtype=np.int64))
+        with open(edge_file, 'wb') as h_out:
+            np.savez_compressed(h_out, source=np.asarray(source, dtype=np.int64),
+                                target=np.asarray(target, dtype=np.int64), weight=np.asarray(weight))
+
+    elif fmt == 'csv':
+        with open(edge_file, 'w') as h_out:
+            h_out.write("SOURCE TARGET RAWWEIGHT TYPE\n")
+            for u, v, w in zip(source, target, weight):
+                h_out.write('{0} {1} {2} UNDIRECTED\n'.format(names[u], names[v], w))
+
+        with open(node_file, 'w') as h_out:
+            h_out.write('ID LENGTH\n')
+            for v, ln in zip(names, lengths):
+                h_out.write('{0} {1}\n'.format(v, ln))
+
+    else:
+        raise RuntimeError('unsupported table format {0}'.format(fmt))
+
+
+def read_tables(edge_file, node_file):
+    """
+    Read edge and node tables of either format.
+
+    :param edge_file: edge table file
+    :param node_file: node table file
+    :return: DataFrames (edges, nodes), with columns SOURCE TARGET RAWWEIGHT and ID LENGTH
+    """
+    npz_edges = is_npz(edge_file)
+    if npz_edges != is_npz(node_file):
+        raise RuntimeError('edge and node tables must be of the same format')
+
+    if not npz_edges:
+        edges = pd.read_csv(edge_file, sep=' ', dtype={'SOURCE': str, 'TARGET': str})
+        nodes = pd.read_csv(node_file, sep=' ', dtype={'ID': str, 'LENGTH': int})
+        return edges, nodes
+
+    node_npz = np.load(node_file)
+    edge_npz = np.load(edge_file)
+    names = node_npz['id'].astype(str)
+    nodes = pd.DataFrame({'ID': names, 'LENGTH': node_npz['length']}, columns=['ID', 'LENGTH'])
+    edges = pd.DataFrame({'SOURCE': names[edge_npz['source']],
+                          'TARGET': names[edge_npz['target']],
+                          'RAWWEIGHT': edge_npz['weight']}, columns=['SOURCE', 'TARGET', 'RAWWEIGHT'])
+    return edges, nodes
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import pandas as pd
 import sys
 
+import graph_tables
+
 if len(sys.argv) != 5:
     print 'Usage: [min length] [edges csv] [nodes csv] [output]'
     sys.exit(1)
@@ -10,9 +11,8 @@ if len(sys.argv) != 5:
 # Minimum sequence length
 minLength = int(sys.argv[1])
 
-# Load edge and node tables
-edges = pd.read_csv(sys.argv[2], sep=' ')
-nodes = pd.read_csv(sys.argv[3], sep=' ')
+# Load edge and node tables, either csv or npz
+edges, nodes = graph_tables.read_tables(sys.argv[2], sys.argv[3])
 
 # Filter out edges that aren't in 'keepers'
 keepers = nodes[nodes.LENGTH > minLength]
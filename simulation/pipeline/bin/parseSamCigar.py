@@ -1,10 +1,8 @@
 #!/usr/bin/env python
 from Bio import SeqIO
-import re
 import argparse
 
-# CIGAR matcher for aligning regions
-matcher = re.compile(r'([0-9]+)M')
+import cigar_stats
 
 
 def count_aligned(cigar):
@@ -13,7 +11,7 @@ def count_aligned(cigar):
     :param cigar: SAMtools CIGAR string
     :return: total number of aligned bases
     """
-    return sum([int(seg_len) for seg_len in matcher.findall(cigar)])
+    return cigar_stats.string_stats(cigar).match
 
 
 class Alignment:
@@ -3,6 +3,10 @@
 #
 # Filter bam file
 #
+# Further [mincov] [minqual] [out bam] triplets filter the same
+# input to additional outputs in a single pass. The input must be
+# coordinate sorted, as the outputs are indexed without resorting.
+#
 
 #$ -e logs/
 #$ -o logs/
@@ -21,29 +25,53 @@ SAMTOOLS=external/samtools
 if [ -z "$JOB_ID" ] # SUBMIT MODE
 then
 
-	if [ $# -ne 4 ]
+	if [ $# -lt 4 ] || [ $(( ($# - 4) % 3 )) -ne 0 ]
 	then
-		echo "Usage: [mincov] [minqual] [in bam] [out bam]"
+		echo "Usage: [mincov] [minqual] [in bam] [out bam] [[mincov] [minqual] [out bam]]..."
 		exit 1
 	fi
 
+	# pack thresholds and outputs as colon separated lists
+	MINCOV=$1
+	MINQUAL=$2
+	BAMFILE=$3
+	OUTPUT=$4
+	shift 4
+	while [ $# -gt 0 ]
+	do
+		MINCOV=$MINCOV:$1
+		MINQUAL=$MINQUAL:$2
+		OUTPUT=$OUTPUT:$3
+		shift 3
+	done
+
 	echo "Submitting run"
-	#trap 'rollback_rm_file $4; exit $?' INT TERM EXIT
+	#trap 'rollback_rm_files ${OUTPUT//:/ }; exit $?' INT TERM EXIT
 	CMD=`readlink -f $0`
-	qsub -sync yes -V -v MINCOV=$1,MINQUAL=$2,BAMFILE=$3,OUTPUT=$4 $CMD
+	qsub -sync yes -V -v MINCOV=$MINCOV,MINQUAL=$MINQUAL,BAMFILE=$BAMFILE,OUTPUT=$OUTPUT $CMD
 	#trap - INT TERM EXIT
 	echo "Finished"
 
 else # EXECUTION MODE
 	echo "Running"
 
-    BASE=${OUTPUT%.bam}
+    IFS=':' read -a COVS <<< "$MINCOV"
+    IFS=':' read -a QUALS <<< "$MINQUAL"
+    IFS=':' read -a OUTS <<< "$OUTPUT"
+
+    GRID=""
+    for (( i=1; i<${#OUTS[@]}; i++ ))
+    do
+        GRID="$GRID --grid ${COVS[$i]} ${QUALS[$i]} ${OUTS[$i]}"
+    done
 
-	$FILTERBAM --mincov $MINCOV --minqual $MINQUAL $BAMFILE ${BASE}.tmp
-    $SAMTOOLS sort ${BASE}.tmp $BASE
-    $SAMTOOLS index $OUTPUT
-    $SAMTOOLS idxstats $OUTPUT > ${BASE}.idxstats
-    $SAMTOOLS flagstat $OUTPUT > ${BASE}.flagstat
-    rm ${BASE}.tmp
+	# filtering preserves the input's order, so outputs are indexed directly
+	$FILTERBAM --index --mincov ${COVS[0]} --minqual ${QUALS[0]} $GRID $BAMFILE ${OUTS[0]}
+    for OUT in "${OUTS[@]}"
+    do
+        BASE=${OUT%.bam}
+        $SAMTOOLS idxstats $OUT > ${BASE}.idxstats
+        $SAMTOOLS flagstat $OUT > ${BASE}.flagstat
+    done
 
 fi